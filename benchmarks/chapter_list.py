@@ -0,0 +1,69 @@
+"""
+Compares per-chapter scene queries with the single aggregation used by `/list chapters`.
+Run from the repository root: `python -m benchmarks.chapter_list`
+Uses (and drops afterwards) a separate `fearless_benchmark` database.
+"""
+import time
+import asyncio
+
+import beanie
+from motor import motor_asyncio
+
+from config import load_settings
+from extensions.character_models import Actor, Character, Chapter, Scene
+
+CHAPTERS = 50
+SCENES = 40
+ROUNDS = 5
+GUILD_ID = 0
+
+
+async def seed():
+    chapters = [Chapter(guild_id=GUILD_ID, name=f"Chapter {i}", number=i) for i in range(1, CHAPTERS + 1)]
+    await Chapter.insert_many(chapters)
+    chapters = await Chapter.all().to_list()
+
+    scenes = [Scene(guild_id=GUILD_ID, name=f"Scene {chapter.number}-{i}", number=i, chapter=chapter)
+              for chapter in chapters for i in range(1, SCENES + 1)]
+    await Scene.insert_many(scenes)
+    return chapters
+
+
+async def per_chapter(chapters, with_scenes):
+    for chapter in chapters:
+        if with_scenes:
+            await chapter.scenes.to_list()
+        else:
+            await chapter.scenes.count()
+
+
+async def aggregated(chapters, with_scenes):
+    await Scene.chapter_summaries(GUILD_ID, with_scenes=with_scenes)
+
+
+async def measure(func, *args):
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        await func(*args)
+    return (time.perf_counter() - start) / ROUNDS * 1000
+
+
+async def main():
+    config = load_settings()
+    client = motor_asyncio.AsyncIOMotorClient(config.database_address)
+    await beanie.init_beanie(database=client.fearless_benchmark, document_models=[Actor, Character, Chapter, Scene])
+    try:
+        chapters = await seed()
+        chapters.sort(key=lambda chapter: chapter.number)
+        print(f"{CHAPTERS} chapters x {SCENES} scenes, average of {ROUNDS} rounds")
+        for with_scenes in (False, True):
+            mode = "scenes" if with_scenes else "counts"
+            old = await measure(per_chapter, chapters, with_scenes)
+            new = await measure(aggregated, chapters, with_scenes)
+            print(f"{mode:<6} | per chapter: {old:8.2f} ms | aggregation: {new:8.2f} ms | x{old / new:.1f}")
+    finally:
+        await client.drop_database("fearless_benchmark")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,12 +1,17 @@
+from operator import attrgetter
+
 import naff
 from naff import slash_str_option, slash_int_option, slash_bool_option
 from naff import InteractionContext, AutocompleteContext, Permissions
 from naff.client.utils import TTLCache
 
+from utils.db import NumberedNameRecord
 from utils.intractions import yes_no
 from utils.exceptions import InvalidArgument
-from utils.text import make_table, format_entry, pluralize
-from utils.commands import manage_cmd, list_cmd, info_cmd, generic_rename, generic_move, generic_autocomplete
+from utils.text import make_table, join_lines, pluralize
+from utils.pagination import Paginator, numbered_entries
+from utils.autocomplete import coalesce_autocomplete
+from utils.commands import get_guild_id, manage_cmd, list_cmd, info_cmd, generic_rename, generic_move, generic_autocomplete
 
 from extensions.character_models import Character, Scene, Chapter
 
@@ -34,13 +39,13 @@ class ChapterCmd(naff.Extension):
     ):
         """Adds a new chapter"""
         await ctx.defer(ephemeral=True)
-        chapter_obj = Chapter(name=name)
+        chapter_obj = Chapter(guild_id=get_guild_id(ctx), name=name)
         await chapter_obj.insert()
         self.set_last_chapter(ctx, chapter_obj)
 
         embed = naff.Embed(color=naff.MaterialColors.GREEN)
         embed.description = f"Created chapter '**{chapter_obj.name}**' (**#{chapter_obj.number}**)"
-        embed.fields.append(await self.chapters_field())
+        embed.fields.append(await self.chapters_field(chapter_obj.guild_id))
         await ctx.send(embed=embed)
 
     @chapter_cmd.subcommand("remove")
@@ -51,7 +56,7 @@ class ChapterCmd(naff.Extension):
     ):
         """Removes a chapter"""
         await ctx.defer(ephemeral=True)
-        chapter_obj = await Chapter.fuzzy_find(chapter)
+        chapter_obj = await Chapter.fuzzy_find(get_guild_id(ctx), chapter)
         await chapter_obj.fetch_all_links()
         await chapter_obj.delete()
         async for scene in chapter_obj.scenes:
@@ -60,7 +65,7 @@ class ChapterCmd(naff.Extension):
 
         embed = naff.Embed(color=naff.MaterialColors.DEEP_ORANGE)
         embed.description = f"Removed chapter '**{chapter_obj.name}**'"
-        embed.fields.append(await self.chapters_field())
+        embed.fields.append(await self.chapters_field(chapter_obj.guild_id))
         await ctx.send(embed=embed)
 
     @chapter_remove.autocomplete("chapter")
@@ -76,11 +81,11 @@ class ChapterCmd(naff.Extension):
     ):
         """Renames a chapter"""
         await ctx.defer(ephemeral=True)
-        chapter_obj = await Chapter.fuzzy_find(chapter)
+        chapter_obj = await Chapter.fuzzy_find(get_guild_id(ctx), chapter)
         self.set_last_chapter(ctx, chapter_obj)
 
         embed = await generic_rename(chapter_obj, "chapter", new_name)
-        embed.fields.append(await self.chapters_field(highlight=chapter_obj))
+        embed.fields.append(await self.chapters_field(chapter_obj.guild_id, highlight=chapter_obj))
         await ctx.send(embed=embed)
 
     @chapter_rename.autocomplete("chapter")
@@ -96,11 +101,11 @@ class ChapterCmd(naff.Extension):
     ):
         """Changes a position (number) of the chapter"""
         await ctx.defer(ephemeral=True)
-        chapter_obj = await Chapter.fuzzy_find(chapter)
+        chapter_obj = await Chapter.fuzzy_find(get_guild_id(ctx), chapter)
         self.set_last_chapter(ctx, chapter_obj)
 
         embed = await generic_move(chapter_obj, "chapter", new_position)
-        embed.fields.append(await self.chapters_field(highlight=chapter_obj))
+        embed.fields.append(await self.chapters_field(chapter_obj.guild_id, highlight=chapter_obj))
         await ctx.send(embed=embed)
 
     @chapter_move.autocomplete("chapter")
@@ -113,16 +118,15 @@ class ChapterCmd(naff.Extension):
                            ):
         """List all chapters"""
         await ctx.defer()
-        embed = naff.Embed(description="", color=naff.MaterialColors.LIGHT_BLUE)
-
         show_scenes_count = True
-        chapters = await Chapter.all().sort("+number").to_list()
+        guild_id = get_guild_id(ctx)
+        query = Chapter.in_guild(guild_id).sort("+number")
 
         if not list_scenes:
-            async def make_row(chapter: Chapter):
-                row = [chapter.fullname]
+            def make_row(chapter: NumberedNameRecord, summaries: dict):
+                row = [f"{chapter.number}. {chapter.name}"]
                 if show_scenes_count:
-                    scenes_count = await chapter.scenes.count()
+                    scenes_count = summaries.get(chapter.id, {}).get("count", 0)
                     row.append(pluralize(scenes_count, "scene"))
                 return row
 
@@ -130,40 +134,51 @@ class ChapterCmd(naff.Extension):
             if show_scenes_count:
                 wrap_column.append(True)
 
-            chapters_rows = [await make_row(chapter) for chapter in chapters]
-            chapters_text = "\n".join(make_table(chapters_rows, wrap_column))
-            # embed.add_field(name=f"Chapters [{len(chapters)} total]", value=chapters_text)
-            embed.title = f"Chapters list"
-            embed.description = chapters_text
-        else:
-            embed.title = "Chapters and scenes list"
-            for chapter in chapters:
-                scenes = await chapter.scenes.to_list()
-                scenes_text = "\n".join([f"{scene.number}. *{scene.name}*" for scene in scenes])
-                embed.add_field(name=f"{chapter.fullname}", value=scenes_text or "No scenes!")
-
-        await ctx.send(embed=embed)
+            async def render(chapters: list[NumberedNameRecord], paginator: Paginator):
+                summaries = await Scene.chapter_summaries(guild_id, [chapter.id for chapter in chapters])
+                chapters_rows = [make_row(chapter, summaries) for chapter in chapters]
+                embed = naff.Embed(title="Chapters list", color=naff.MaterialColors.LIGHT_BLUE)
+                embed.description = join_lines(make_table(chapters_rows, wrap_column), limit=4096)
+                return embed
 
+            paginator = Paginator(query, render, page_size=30, record=NumberedNameRecord)
+        else:
+            async def render(chapters: list[NumberedNameRecord], paginator: Paginator):
+                summaries = await Scene.chapter_summaries(guild_id, [chapter.id for chapter in chapters],
+                                                          with_scenes=True)
+                embed = naff.Embed(title="Chapters and scenes list", color=naff.MaterialColors.LIGHT_BLUE)
+                for chapter in chapters:
+                    scenes = summaries.get(chapter.id, {}).get("scenes", [])
+                    scenes_text = join_lines([f"{scene['number']}. *{scene['name']}*" for scene in scenes])
+                    embed.add_field(name=f"{chapter.number}. {chapter.name}", value=scenes_text or "No scenes!")
+                return embed
+
+            # each field can take up to 1024 characters, and the whole embed no more than 6000
+            paginator = Paginator(query, render, page_size=5, record=NumberedNameRecord)
+
+        await paginator.send(ctx)
+
+    @coalesce_autocomplete
     async def chapter_autocomplete(self, ctx: AutocompleteContext, query: str, only_with_scenes: bool = False):
-        db_query = Chapter.all().sort("+number")
+        guild_id = get_guild_id(ctx)
+        where = None
         if only_with_scenes:
-            scenes = await Scene.all().to_list()
-            chapter_ids = {scene.chapter.ref.id for scene in scenes}
-            db_query = db_query.find({"_id": {"$in": list(chapter_ids)}})
+            chapter_ids = await Scene.chapter_ids(guild_id)
+            where = lambda entry: entry.id in chapter_ids
 
         last_chapter_id = self.get_last_chapter(ctx)
 
-        results = await generic_autocomplete(query, db_query, last_chapter_id, use_numbers=True)
-        results = [{"name": f"{chapter.number}. {chapter.name}", "value": chapter.name} for chapter in results]
-        await ctx.send(results)
+        results = await generic_autocomplete(query, Chapter, guild_id, last_chapter_id, use_numbers=True,
+                                             where=where, sort_key=attrgetter("number"))
+        return [{"name": f"{chapter.number}. {chapter.name}", "value": chapter.name} for chapter in results]
 
     @classmethod
-    async def chapters_field(cls, highlight=None):
-        chapters = await Chapter.all().sort("+number").to_list()
+    async def chapters_field(cls, guild_id: int, highlight=None):
+        chapters_text, total = await numbered_entries(Chapter.in_guild(guild_id), highlight)
 
         field = naff.EmbedField(
-            name=f"Chapters [{len(chapters)} total]:",
-            value="\n".join([format_entry(chapter, highlight) for chapter in chapters])
+            name=f"Chapters [{total} total]:",
+            value=chapters_text or "No chapters!",
         )
 
         return field
@@ -1,19 +1,24 @@
 import logging
+from copy import deepcopy
 from typing import TYPE_CHECKING
-from bson import dbref
+from operator import attrgetter
 
 import naff
 from naff import SlashCommandChoice, subcommand, slash_str_option, slash_user_option, slash_bool_option, \
     slash_int_option
 from naff import InteractionContext, AutocompleteContext, Permissions
 
-from utils.text import make_table, pluralize
+from utils.text import make_table, join_lines, pluralize
+from utils.pagination import Paginator
+from utils.autocomplete import coalesce_autocomplete
+from utils.roles import RoleReconciler
 from utils.fuzz import fuzzy_autocomplete
 from utils.intractions import yes_no
 from utils.exceptions import InvalidArgument
-from utils.commands import manage_cmd, list_cmd, generic_rename, generic_autocomplete
+from utils.commands import get_guild_id, manage_cmd, list_cmd, info_cmd, generic_rename, generic_autocomplete
 
-from extensions.character_models import Actor, Character, Scene, Chapter, CharacterGrade
+from extensions.character_models import Actor, Character, CharacterRow, FeaturedSceneRow, Scene, Chapter, \
+    CharacterGrade
 
 if TYPE_CHECKING:
     from extensions.chapter import ChapterCmd
@@ -30,10 +35,16 @@ grade_roles = {
     2: "Secondary Character",
     3: "Tertiary Character",
 }
-role_grades = {value: key for key, value in grade_roles.items()}
 
 
 class CharacterCmd(naff.Extension):
+    def __init__(self, client):
+        self.roles = RoleReconciler(client, list(grade_roles.values()), self.desired_roles)
+
+    def drop(self):
+        self.roles.cancel()
+        super().drop()
+
     @character_cmd.subcommand("create")
     async def character_create(
             self,
@@ -44,7 +55,7 @@ class CharacterCmd(naff.Extension):
     ):
         """Adds a new character (but you can also just use /character assign)"""
         await ctx.defer(ephemeral=True)
-        character_obj = Character(name=name, grade=grade)
+        character_obj = Character(guild_id=get_guild_id(ctx), name=name, grade=grade)
         await character_obj.insert()
 
         embed = naff.Embed(color=naff.MaterialColors.GREEN)
@@ -59,22 +70,11 @@ class CharacterCmd(naff.Extension):
     ):
         """Removes a character"""
         await ctx.defer(ephemeral=True)
-        character_obj = await Character.fuzzy_find(character)
-        if character_obj.actor is not None:
-            actor = await character_obj.actor.fetch()
-        else:
-            actor = None
+        character_obj = await Character.fuzzy_find(get_guild_id(ctx), character)
         await character_obj.delete()
 
-        # remove ref to this character in scenes
-        scenes: list[Scene] = await Scene.find(
-            {"characters": {"$elemMatch": dbref.DBRef("Character", character_obj.id)}}
-        ).to_list()
-        for scene in scenes:
-            scene.characters = [link for link in scene.characters if link.ref.id != character_obj.id]
-            await scene.save()
-        if actor is not None:
-            await self.enforce_roles(ctx.guild, actor)
+        await Scene.remove_character_everywhere(character_obj.guild_id, character_obj.id)
+        self.roles.queue(ctx.guild.id, character_obj.actor_id)
 
         embed = naff.Embed(color=naff.MaterialColors.DEEP_ORANGE)
         embed.description = f"Removed character '**{character_obj.name}**'!"
@@ -93,7 +93,7 @@ class CharacterCmd(naff.Extension):
     ):
         """Renames a character"""
         await ctx.defer(ephemeral=True)
-        character_obj = await Character.fuzzy_find(character)
+        character_obj = await Character.fuzzy_find(get_guild_id(ctx), character)
         embed = await generic_rename(character_obj, "character", new_name)
         await ctx.send(embed=embed)
 
@@ -111,12 +111,11 @@ class CharacterCmd(naff.Extension):
     ):
         """Changes a character's grade (Primary, Secondary, Tertiary)"""
         await ctx.defer(ephemeral=True)
-        character_obj = await Character.fuzzy_find(character)
+        character_obj = await Character.fuzzy_find(get_guild_id(ctx), character)
         old_grade = character_obj.grade
         character_obj.grade = grade
         await character_obj.save()
-        actor = await character_obj.actor.fetch()
-        await self.enforce_roles(ctx.guild, actor)
+        self.roles.queue(ctx.guild.id, character_obj.actor_id)
 
         embed = naff.Embed()
         if old_grade == character_obj.grade:
@@ -142,7 +141,7 @@ class CharacterCmd(naff.Extension):
         """Assign an actor to the character"""
         await ctx.defer(ephemeral=True)
         try:
-            character_obj = await Character.fuzzy_find(character)
+            character_obj = await Character.fuzzy_find(get_guild_id(ctx), character)
         except InvalidArgument:
             result, btn_ctx = await yes_no(
                 ctx,
@@ -151,9 +150,9 @@ class CharacterCmd(naff.Extension):
             )
             if result:
                 actor = await Actor.get_or_insert(member)
-                character_obj = Character(name=character, actor=actor)
+                character_obj = Character(guild_id=actor.guild_id, name=character, actor=actor)
                 character_obj = await character_obj.insert()
-                await self.enforce_roles(ctx.guild, actor)
+                self.roles.queue(ctx.guild.id, actor.id)
 
                 embed = naff.Embed(description="Done!", color=naff.MaterialColors.GREEN)
                 await btn_ctx.edit_origin(embed=embed, components=[])
@@ -191,10 +190,11 @@ class CharacterCmd(naff.Extension):
                 color = naff.MaterialColors.GREEN
                 msg = f"Assigned *{character_obj.grade.name.title()}* character '**{character_obj.name}**' to {member.mention}! 🎉"
 
+            old_actor_id = character_obj.actor_id
             actor = await Actor.get_or_insert(member)
             character_obj.actor = actor
             await character_obj.save()
-            await self.enforce_roles(ctx.guild, actor)
+            self.roles.queue(ctx.guild.id, old_actor_id, actor.id)
 
             embed = naff.Embed(description="Done!", color=naff.MaterialColors.GREEN)
             if not ctx.responded:
@@ -218,7 +218,7 @@ class CharacterCmd(naff.Extension):
     ):
         """Clear the role from the assigned actor"""
         await ctx.defer(ephemeral=True)
-        character_obj = await Character.fuzzy_find(character)
+        character_obj = await Character.fuzzy_find(get_guild_id(ctx), character)
         await character_obj.fetch_all_links()
         if character_obj.actor is None:
             raise InvalidArgument(f"Character '**{character}**' is already free and without an actor :(")
@@ -227,7 +227,7 @@ class CharacterCmd(naff.Extension):
         actor = character_obj.actor
         character_obj.actor = None
         await character_obj.save()
-        await self.enforce_roles(ctx.guild, actor)
+        self.roles.queue(ctx.guild.id, actor.id)
 
         embed = naff.Embed(color=naff.MaterialColors.DEEP_ORANGE)
         embed.description = f"Removed {old_member_mention} as an actor for the character {character}"
@@ -237,6 +237,54 @@ class CharacterCmd(naff.Extension):
     async def character_free_autocomplete(self, ctx: AutocompleteContext, character: str, **_):
         return await self.character_autocomplete(ctx, character, free=False)
 
+    @character_cmd.subcommand("sync_roles")
+    async def character_sync_roles(self, ctx: InteractionContext):
+        """Updates grade roles of all actors to match their characters"""
+        await ctx.defer(ephemeral=True)
+        edited = await self.roles.resync_all(get_guild_id(ctx))
+
+        embed = naff.Embed(color=naff.MaterialColors.INDIGO)
+        embed.description = f"Synchronized roles of all actors, updated {edited} member(s)"
+        await ctx.send(embed=embed)
+
+    @info_cmd.subcommand("character")
+    async def character_info(
+            self,
+            ctx: InteractionContext,
+            character: slash_str_option("character to show", required=True, autocomplete=True),
+    ):
+        """Shows a character and scenes it appears in"""
+        await ctx.defer()
+        character_obj = await Character.fuzzy_find(get_guild_id(ctx), character)
+        total = await Scene.featuring(character_obj.guild_id, character_obj.id).count()
+        if character_obj.actor_id is not None:
+            actor = await Actor.get(character_obj.actor_id)
+            actor_text = actor.raw_mention if actor is not None else "[**FREE**]"
+        else:
+            actor_text = "[**FREE**]"
+
+        def scene_line(scene: FeaturedSceneRow):
+            chapter_text = f"{scene.chapter_number}. {scene.chapter_name}" if scene.chapter_name is not None else "?"
+            return f"{chapter_text} → {scene.number}. *{scene.name}*"
+
+        async def render(scenes: list[FeaturedSceneRow], paginator: Paginator):
+            embed = naff.Embed(color=naff.MaterialColors.LIGHT_BLUE)
+            embed.title = character_obj.name
+            embed.description = f"*{character_obj.grade.name.title()}* character, actor: {actor_text}"
+            embed.add_field(
+                name=f"Appears in {pluralize(total, 'scene')}",
+                value=join_lines([scene_line(scene) for scene in scenes]) or "No scenes yet!",
+            )
+            return embed
+
+        await Paginator(Scene.featuring_rows(character_obj.guild_id, character_obj.id), render).send(
+            ctx, allowed_mentions=naff.AllowedMentions.none()
+        )
+
+    @character_info.autocomplete("character")
+    async def character_info_autocomplete(self, ctx: AutocompleteContext, character: str, **_):
+        return await self.character_autocomplete(ctx, character)
+
     @list_cmd.subcommand("characters")
     async def character_list(
             self,
@@ -252,12 +300,11 @@ class CharacterCmd(naff.Extension):
     ):
         """List all characters with filters applied"""
         await ctx.defer()
-        embed = naff.Embed(color=naff.MaterialColors.LIGHT_BLUE)
 
-        chapter_obj = await Chapter.fuzzy_find(chapter) if chapter else None
+        chapter_obj = await Chapter.resolve(ctx, chapter) if chapter else None
         if scene:
             if chapter_obj:
-                scene_obj = await Scene.fuzzy_find(chapter_obj, scene)
+                scene_obj = await Scene.resolve(ctx, chapter_obj, scene)
                 self.scene_ext.set_last_scene(ctx, chapter_obj, scene_obj)
             else:
                 raise InvalidArgument("You must specify a chapter to filter characters by scene!")
@@ -266,7 +313,7 @@ class CharacterCmd(naff.Extension):
             if chapter_obj:
                 self.chapter_ext.set_last_chapter(ctx, chapter_obj)
 
-        description, characters_text, characters = await self.make_character_list(
+        description, db_query, make_text = await self.make_character_list(
             ctx=ctx,
             member=member,
             free_characters=free_characters,
@@ -274,13 +321,19 @@ class CharacterCmd(naff.Extension):
             chapter=chapter_obj,
             scene=scene_obj,
         )
-        embed.add_field(
-            f"Displaying {pluralize(len(characters), 'character')}", characters_text or "No characters available!"
-        )
+        total = await deepcopy(db_query).count()
 
-        embed.title = "Character list"
-        embed.description = description
-        await ctx.send(embed=embed)
+        async def render(characters: list[CharacterRow], paginator: Paginator):
+            embed = naff.Embed(color=naff.MaterialColors.LIGHT_BLUE)
+            embed.add_field(
+                f"Displaying {pluralize(total, 'character')}", await make_text(characters) or "No characters available!"
+            )
+
+            embed.title = "Character list"
+            embed.description = description
+            return embed
+
+        await Paginator(db_query, render, page_size=15).send(ctx)
 
     @character_list.autocomplete("chapter")
     async def character_list_autocomplete_chapter(self, ctx: AutocompleteContext, chapter: str, **_):
@@ -300,14 +353,14 @@ class CharacterCmd(naff.Extension):
                                   scene: Scene | None = None,
                                   ):
         description_lines = []
-        db_query = Character.all()
+        match = {}
 
         show_actors = True
         show_grade = True
 
         if grade:
             description_lines.append(f"Showing only *{CharacterGrade(grade).name.title()}* characters")
-            db_query = db_query.find({"grade": grade})
+            match["grade"] = grade
             show_grade = False
 
         if free_characters is not None:
@@ -315,17 +368,17 @@ class CharacterCmd(naff.Extension):
                 raise InvalidArgument("You should not specify `member` and `free_characters` options at the same time!")
 
             if free_characters:
-                db_query = db_query.find({"actor": None})
+                match["actor"] = None
                 description_lines.append("Showing only **free** characters")
                 show_actors = False
             else:
-                db_query = db_query.find({"actor": {"$ne": None}})
+                match["actor"] = {"$ne": None}
                 description_lines.append("Showing only **assigned** characters")
 
         if member:
             actor = await Actor.get_by_member(member)
             if actor:
-                db_query = db_query.find({"actor.$id": actor.id})
+                match["actor.$id"] = actor.id
                 description_lines.append(f"Showing characters with actor: {member.mention}")
                 show_actors = False
             else:
@@ -334,27 +387,22 @@ class CharacterCmd(naff.Extension):
         if chapter:
             if scene:
                 description_lines.append(f"Showing only in scene '**{scene.name}**' of chapter '**{chapter.name}**'")
-                scenes = [scene]
             else:
                 description_lines.append(f"Showing only in chapter '**{chapter.name}**'")
-                scenes = await Scene.in_chapter(chapter.id).to_list()
-            ids = []
-            for scene_obj in scenes:
-                ids.extend([link.ref.id for link in scene_obj.characters])
-            db_query.find({"_id": {"$in": list(set(ids))}})
 
-        characters = await db_query.sort("+grade", "+name").to_list()
+        db_query = Character.list_query(get_guild_id(ctx), match,
+                                        chapter_id=chapter.id if chapter else None,
+                                        scene_id=scene.id if chapter and scene else None)
 
-        async def make_row(character: Character):
-            await character.fetch_all_links()
+        def make_row(character: CharacterRow):
             row = [character.name]
             if show_grade:
-                row.append(character.grade.name.title())
+                row.append(CharacterGrade(character.grade).name.title())
             if show_actors:
-                if character.actor is None:
+                if character.user_id is None:
                     row.append("[**FREE**]")
                 else:
-                    row.append(await character.actor.mention(ctx))
+                    row.append(f"<@{character.user_id}>")
             return row
 
         wrap_column = [True]
@@ -365,12 +413,12 @@ class CharacterCmd(naff.Extension):
         if len(wrap_column) == 1:
             wrap_column[0] = False
 
-        print(characters)
-        characters_rows = [await make_row(character) for character in characters]
-        characters_text = "\n".join(make_table(characters_rows, wrap_column))
+        async def make_text(characters: list[CharacterRow]) -> str:
+            characters_rows = [make_row(character) for character in characters]
+            return join_lines(make_table(characters_rows, wrap_column))
 
         description = "\n".join(description_lines).strip()
-        return description, characters_text, characters
+        return description, db_query, make_text
 
     @property
     def chapter_ext(self) -> "ChapterCmd":
@@ -381,87 +429,38 @@ class CharacterCmd(naff.Extension):
         return self.bot.get_ext("SceneCmd")  # type: ignore
 
     @classmethod
+    @coalesce_autocomplete
     async def character_autocomplete(cls, ctx: AutocompleteContext, query: str, free=None,
                                      exclude_scene=None, only_scene=None,
                                      ):
-        db_query = Character.all()
-        if free is False:
-            db_query.find({"actor": {"$ne": None}})
-
-        if exclude_scene:
-            ids = [link.ref.id for link in exclude_scene.characters]
-            db_query.find({"_id": {"$nin": ids}})
-        if only_scene:
-            ids = [link.ref.id for link in only_scene.characters]
-            db_query.find({"_id": {"$in": ids}})
-
-        db_query = db_query.sort("+grade", "+name")
-        results = await generic_autocomplete(query, db_query, use_numbers=False)
+        def where(entry):
+            if free is False and entry.actor_id is None:
+                return False
+            if exclude_scene and entry.id in exclude_scene.character_ids:
+                return False
+            if only_scene and entry.id not in only_scene.character_ids:
+                return False
+            return True
+
+        results = await generic_autocomplete(query, Character, get_guild_id(ctx), use_numbers=False,
+                                             where=where, sort_key=attrgetter("grade", "name"))
+
+        actor_ids = {character.actor_id for character in results if character.actor_id is not None}
+        actors = await Actor.find({"_id": {"$in": list(actor_ids)}}).to_list() if actor_ids else []
+        actors = {actor.id: actor for actor in actors}
 
         async def get_actor(character):
-            await character.fetch_all_links()
-            if character.actor is None:
+            actor = actors.get(character.actor_id)
+            if actor is None:
                 return "[FREE]"
-            return await character.actor.display_name(ctx.guild)
-
-        results = [{"name": f"{character.name} | {await get_actor(character)}", "value": character.name}
-                   for character in results]
+            return await actor.display_name(ctx.guild)
 
-        await ctx.send(results)
+        return [{"name": f"{character.name} | {await get_actor(character)}", "value": character.name}
+                for character in results]
 
-    @classmethod
-    async def enforce_roles(cls, guild: naff.Guild, actor: Actor):
-        member = await actor.member(guild)
-        if member is None:
-            return
-
-        current = {role_grades.get(role.name) for role in member.roles}
-        current.discard(None)
-
-        characters = await Character.find({"actor.$id": actor.id}).to_list()
-        grades = set(character.grade.value for character in characters)
-        if not grades:
-            grades = {0}
-
-        to_remove = current.difference(grades)
-        to_add = grades.difference(current)
-
-        all_grades = to_add.union(to_remove)
-
-        async def get_role(grade: int):
-            role_name = grade_roles[grade]
-            try:
-                return await cls.get_role(guild, role_name)
-            except naff.errors.Forbidden as e:
-                logger.warning(f"Could not get/create role `{role_name}` in {guild}: {e}")
-                return None
-
-        roles = {grade: await get_role(grade) for grade in all_grades}
-        roles = {grade: role for grade, role in roles.items() if role is not None}
-
-        for grade in to_remove:
-            if grade in roles:
-                role = roles[grade]
-                try:
-                    await member.remove_role(role, "Automatically removed to match assigned characters")
-                except naff.errors.Forbidden as e:
-                    logger.warning(f"Could not remove role `{role}` from {member} in {guild}: {e}")
-
-        for grade in to_add:
-            if grade in roles:
-                role = roles[grade]
-                try:
-                    await member.add_role(roles[grade], "Automatically added to match assigned characters")
-                except naff.errors.Forbidden as e:
-                    logger.warning(f"Could not assign role `{role}` from {member} in {guild}: {e}")
-
-    @staticmethod
-    async def get_role(guild: naff.Guild, role_name: str) -> naff.Role:
-        for role in guild.roles:
-            if role.name == role_name:
-                return role
-
-        return await guild.create_role(name=role_name)
+    async def desired_roles(self, guild_id: int, actor_ids: list | None) -> dict[int, set[str]]:
+        grades = await Actor.character_grades(guild_id, actor_ids)
+        return {user_id: {grade_roles[grade] for grade in user_grades or {0}} for user_id, user_grades in grades.items()}
 
 
 def setup(bot):
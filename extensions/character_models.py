@@ -1,29 +1,41 @@
 import enum
+from typing import NamedTuple
+
 import naff
 import beanie
+import pymongo
+from bson import ObjectId, DBRef
 from naff import InteractionContext
+from pymongo.collation import Collation, CollationStrength
 from pydantic import Field, validator
 
-from utils.db import Document, validate_name, reshuffle_numbers
+from utils.db import GuildDocument, IndexedDocument, NumberedDocument, NameIndex, AggregationQuery, validate_name
 from utils.fuzz import fuzzy_find_obj
+from utils.commands import get_guild_id, resolve_option, resolve_option_entry
 from utils.exceptions import InvalidArgument
 
 
-class Actor(Document):
-    user_id: beanie.Indexed(int)
+class Actor(GuildDocument):
+    user_id: int
     user_tag: str
 
+    class Settings:
+        validate_on_save = True
+        indexes = [
+            pymongo.IndexModel([("guild_id", pymongo.ASCENDING), ("user_id", pymongo.ASCENDING)]),
+        ]
+
     @classmethod
     async def get_or_insert(cls, member: naff.Member):
-        actor = await cls.find_one({'user_id': member.id})
+        actor = await cls.get_by_member(member)
         if actor is None:
-            actor = cls(user_id=member.id, user_tag=member.tag)
+            actor = cls(guild_id=member.guild.id, user_id=member.id, user_tag=member.tag)
             actor = await actor.insert()
         return actor
 
     @classmethod
     async def get_by_member(cls, member: naff.Member):
-        return await cls.find_one({'user_id': member.id})
+        return await cls.find_one({'guild_id': member.guild.id, 'user_id': member.id})
 
     async def member(self, guild: naff.Guild) -> naff.Member | None:
         return await guild.fetch_member(self.user_id)
@@ -46,6 +58,34 @@ class Actor(Document):
         else:
             return self.user_tag
 
+    @property
+    def raw_mention(self) -> str:
+        # Discord renders mentions from the id alone, no need to fetch the user for that
+        return f"<@{self.user_id}>"
+
+    @classmethod
+    async def character_grades(cls, guild_id: int, actor_ids: list[ObjectId] | None = None) -> dict[int, set[int]]:
+        """Grades of the characters of every (or every listed) actor, by user id, in a single aggregation"""
+        characters_match = {"guild_id": guild_id, "actor": {"$ne": None}}
+        actors_match = {"guild_id": guild_id}
+        if actor_ids is not None:
+            characters_match["actor.$id"] = {"$in": actor_ids}
+            actors_match["_id"] = {"$in": actor_ids}
+
+        pipeline = [
+            {"$match": characters_match},
+            {"$project": {"actor_id": link_id_field("actor"), "grade": 1}},
+            # actors without characters still need their roles reset, so they are grouped in too
+            {"$unionWith": {
+                "coll": cls.get_motor_collection().name,
+                "pipeline": [{"$match": actors_match}, {"$project": {"actor_id": "$_id", "user_id": 1}}],
+            }},
+            {"$group": {"_id": "$actor_id", "user_id": {"$max": "$user_id"}, "grades": {"$addToSet": "$grade"}}},
+            {"$match": {"user_id": {"$ne": None}}},
+        ]
+        results = await Character.aggregate(pipeline).to_list()
+        return {result["user_id"]: set(result["grades"]) for result in results}
+
     async def display_name(self, guild: naff.Guild) -> str:
         if user := await self.member(guild):
             return user.display_name
@@ -59,64 +99,201 @@ class CharacterGrade(enum.IntEnum):
     tertiary = 3
 
 
-class Character(Document):
-    name: beanie.Indexed(str)
+def guild_index(*keys: str) -> pymongo.IndexModel:
+    return pymongo.IndexModel([("guild_id", pymongo.ASCENDING)] + [(key, pymongo.ASCENDING) for key in keys])
+
+
+# Secondary strength ignores case, so "Alice" and "alice" can't both exist
+name_collation = Collation(locale="en", strength=CollationStrength.SECONDARY)
+
+
+def unique_name_index() -> pymongo.IndexModel:
+    # Separate name, because the plain (guild_id, name) index with default collation is still used for lookups
+    return pymongo.IndexModel(
+        [("guild_id", pymongo.ASCENDING), ("name", pymongo.ASCENDING)],
+        unique=True, collation=name_collation, name="guild_id_1_name_1_unique",
+    )
+
+
+class CharacterRow(NamedTuple):
+    id: ObjectId
+    name: str
+    grade: int
+    user_id: int | None  # of the actor, if any
+
+
+class CharacterEntry(NamedTuple):
+    id: ObjectId
+    name: str
+    grade: int
+    actor_id: ObjectId | None
+
+
+class ChapterEntry(NamedTuple):
+    id: ObjectId
+    name: str
+    number: int
+
+
+class SceneEntry(NamedTuple):
+    id: ObjectId
+    name: str
+    number: int
+    chapter_id: ObjectId
+    character_ids: frozenset[ObjectId]
+
+
+class FeaturedSceneRow(NamedTuple):
+    id: ObjectId
+    name: str
+    number: int
+    chapter_name: str | None  # None if the chapter is gone
+    chapter_number: int | None
+
+
+def link_id(link):
+    return link.ref.id if isinstance(link, beanie.Link) else link.id
+
+
+def link_id_field(field: str) -> dict:
+    # "$field.$id" is not a valid aggregation path, so DBRef ids have to be extracted explicitly
+    return {"$getField": {"field": {"$literal": "$id"}, "input": f"${field}"}}
+
+
+class Character(IndexedDocument):
+    name: str
     grade: CharacterGrade = Field(default=CharacterGrade.secondary)
 
     actor: beanie.Link[Actor] | None = Field(None)
 
     validate_name = validator("name", allow_reuse=True)(validate_name)
 
-    @beanie.before_event(beanie.ValidateOnSave)
-    async def validate_db(self):
-        # validate name
-        cls = self.__class__
-        if await cls.find(cls.name == self.name, cls.id != self.id).exists():
-            raise InvalidArgument(f"Character '**{self.name}**' already exists!")
+    class Settings:
+        validate_on_save = True
+        indexes = [
+            guild_index("name"),
+            unique_name_index(),
+            guild_index("grade", "name"),
+            guild_index("actor.$id"),
+        ]
+
+    @property
+    def actor_id(self):
+        return link_id(self.actor) if self.actor is not None else None
+
+    index_fields = ("name", "grade", "actor")
+
+    def index_entry(self) -> CharacterEntry:
+        return CharacterEntry(self.id, self.name, int(self.grade), self.actor_id)
+
+    @classmethod
+    def entry_from_raw(cls, raw: dict) -> CharacterEntry:
+        actor = raw.get("actor")
+        return CharacterEntry(raw["_id"], raw["name"], raw.get("grade", int(CharacterGrade.secondary)),
+                              actor.id if actor is not None else None)
+
+    def duplicate_message(self) -> str:
+        return f"Character '**{self.name}**' already exists!"
+
+    @classmethod
+    def list_query(cls, guild_id: int, match: dict, chapter_id: ObjectId | None = None,
+                   scene_id: ObjectId | None = None) -> AggregationQuery:
+        """Characters matching `match` (and appearing in the chapter/scene), sorted by grade and name, as table rows"""
+        if chapter_id is not None:
+            scene_match = {"guild_id": guild_id, "chapter.$id": chapter_id}
+            if scene_id is not None:
+                scene_match["_id"] = scene_id
+            model = Scene
+            pipeline = [
+                {"$match": scene_match},
+                {"$unwind": "$characters"},
+                {"$group": {"_id": link_id_field("characters")}},
+                {"$lookup": {"from": cls.get_motor_collection().name, "localField": "_id", "foreignField": "_id",
+                             "as": "character"}},
+                {"$unwind": "$character"},
+                {"$replaceRoot": {"newRoot": "$character"}},
+            ]
+        else:
+            model = cls
+            pipeline = []
+
+        pipeline += [
+            {"$match": {"guild_id": guild_id, **match}},
+            {"$sort": {"grade": 1, "name": 1}},
+        ]
+        tail = [
+            {"$addFields": {"actor_id": link_id_field("actor")}},
+            {"$lookup": {"from": Actor.get_motor_collection().name, "localField": "actor_id", "foreignField": "_id",
+                         "as": "actors"}},
+            {"$project": {"name": 1, "grade": 1, "user_id": {"$first": "$actors.user_id"}}},
+        ]
+        return AggregationQuery(model, pipeline, tail, record=CharacterRow)
 
     @classmethod
-    async def fuzzy_find(cls, query: str) -> "Character":
+    async def fuzzy_find(cls, guild_id: int, query: str) -> "Character":
         try:
-            return await fuzzy_find_obj(query, cls.all())
+            return await fuzzy_find_obj(query, cls.in_guild(guild_id), await cls.names(guild_id))
         except ValueError:
             raise InvalidArgument(f"Character with name'**{query}**' not found!")
 
 
-class Chapter(Document):
+class Chapter(NumberedDocument):
     name: str
     number: int = Field(default=None, ge=1)
     # scenes = list[beanie.Link[Scene]]
 
     validate_name = validator("name", allow_reuse=True)(validate_name)
 
-    @beanie.before_event(beanie.ValidateOnSave)
-    async def validate_db(self):
-        # validate name
-        cls = self.__class__
-        if await cls.find(cls.name == self.name, cls.id != self.id).exists():
-            raise InvalidArgument(f"Chapter '**{self.name}**' already exists!")
+    class Settings:
+        validate_on_save = True
+        indexes = [
+            guild_index("name"),
+            unique_name_index(),
+            guild_index("number"),
+        ]
+
+    index_fields = ("name", "number")
+
+    def index_entry(self) -> ChapterEntry:
+        return ChapterEntry(self.id, self.name, self.number)
+
+    @classmethod
+    def entry_from_raw(cls, raw: dict) -> ChapterEntry:
+        return ChapterEntry(raw["_id"], raw["name"], raw.get("number"))
+
+    def duplicate_message(self) -> str:
+        return f"Chapter '**{self.name}**' already exists!"
 
-    @beanie.after_event([beanie.Insert, beanie.Replace, beanie.Delete])
-    async def reshuffle(self):
-        self.number = await reshuffle_numbers(self.__class__.all(), current_instance=self)
+    def siblings(self):
+        return self.in_guild(self.guild_id)
 
     @classmethod
-    async def fuzzy_find(cls, query: str) -> "Chapter":
+    async def fuzzy_find(cls, guild_id: int, query: str) -> "Chapter":
         try:
-            return await fuzzy_find_obj(query, cls.all())
+            return await fuzzy_find_obj(query, cls.in_guild(guild_id), await cls.names(guild_id))
         except ValueError:
             raise InvalidArgument(f"Chapter with name'**{query}**' not found!")
 
+    @classmethod
+    async def resolve(cls, ctx: InteractionContext, query: str) -> "Chapter":
+        guild_id = get_guild_id(ctx)
+        return await resolve_option(ctx, cls, guild_id, query, lambda: cls.fuzzy_find(guild_id, query))
+
+    @classmethod
+    async def resolve_entry(cls, ctx: InteractionContext, query: str) -> ChapterEntry:
+        guild_id = get_guild_id(ctx)
+        return await resolve_option_entry(ctx, cls, guild_id, guild_id, query, lambda: cls.fuzzy_find(guild_id, query))
+
     @property
     def scenes(self):
-        return Scene.find({"chapter.$id": self.id}).sort("+number")
+        return Scene.in_chapter(self.guild_id, self.id).sort("+number")
 
     @property
     def fullname(self):
         return f"{self.number}. {self.name}"
 
 
-class Scene(Document):
+class Scene(NumberedDocument):
     name: str
     number: int = Field(default=None, ge=1)
 
@@ -125,32 +302,150 @@ class Scene(Document):
 
     validate_name = validator("name", allow_reuse=True)(validate_name)
 
+    class Settings:
+        validate_on_save = True
+        indexes = [
+            guild_index("name"),
+            unique_name_index(),
+            guild_index("chapter.$id", "number"),
+            guild_index("characters.$id"),
+        ]
+
     @property
     def chapter_id(self):
-        return self.chapter.ref.id if isinstance(self.chapter, beanie.Link) else self.chapter.id
+        return link_id(self.chapter)
 
-    @beanie.before_event(beanie.ValidateOnSave)
-    async def validate_db(self):
-        # validate name
-        cls = self.__class__
-        if await cls.find(cls.name == self.name, cls.id != self.id).exists():
-            raise InvalidArgument(f"Scene '**{self.name}**' already exists!")
+    @property
+    def character_ids(self):
+        return frozenset(link_id(link) for link in self.characters)
+
+    index_fields = ("name", "number", "chapter", "characters")
+    counted_field = "chapter_id"
 
-    @beanie.after_event([beanie.Insert, beanie.Replace, beanie.Delete])
-    async def reshuffle(self):
-        self.number = await reshuffle_numbers(self.in_chapter(self.chapter_id), current_instance=self)
+    def index_entry(self) -> SceneEntry:
+        return SceneEntry(self.id, self.name, self.number, self.chapter_id, self.character_ids)
+
+    @classmethod
+    def entry_from_raw(cls, raw: dict) -> SceneEntry:
+        character_ids = frozenset(link.id for link in raw.get("characters", []))
+        return SceneEntry(raw["_id"], raw["name"], raw.get("number"), raw["chapter"].id, character_ids)
+
+    def duplicate_message(self) -> str:
+        return f"Scene '**{self.name}**' already exists!"
+
+    def siblings(self):
+        return self.in_chapter(self.guild_id, self.chapter_id)
+
+    async def add_character(self, character_id: ObjectId) -> bool:
+        """Adds the character in a single atomic update (no full save, so no renumbering), returns whether it was added"""
+        link = DBRef(Character.get_motor_collection().name, character_id)
+        result = await self.get_motor_collection().update_one({"_id": self.id}, {"$addToSet": {"characters": link}})
+        self._check_matched(result)
+        if result.modified_count:
+            self._update_characters(self.character_ids | {character_id})
+        return bool(result.modified_count)
+
+    async def remove_character(self, character_id: ObjectId) -> bool:
+        """Removes the character in a single atomic update, returns whether it was in the scene"""
+        link = DBRef(Character.get_motor_collection().name, character_id)
+        result = await self.get_motor_collection().update_one({"_id": self.id}, {"$pull": {"characters": link}})
+        self._check_matched(result)
+        if result.modified_count:
+            self._update_characters(self.character_ids - {character_id})
+        return bool(result.modified_count)
+
+    def _check_matched(self, result):
+        # Nothing matched means the scene was removed after it was resolved, not that there was nothing to change
+        if not result.matched_count:
+            raise InvalidArgument(f"Scene '**{self.name}**' doesn't exist anymore!")
+
+    def _update_characters(self, character_ids: frozenset[ObjectId]):
+        # Mirrors a partial update made directly in the db, skipping validation
+        self.__dict__["characters"] = [Character.link_from_id(character_id) for character_id in character_ids]
+        NameIndex.of(self.__class__).modify(self.guild_id, self.id, character_ids=character_ids)
 
     @classmethod
-    def in_chapter(cls, chapter_id):
-        return cls.find({"chapter.$id": chapter_id})
+    def featuring(cls, guild_id: int, character_id: ObjectId):
+        """Scenes the character appears in"""
+        return cls.find({"guild_id": guild_id, "characters.$id": character_id})
+
+    @classmethod
+    def featuring_rows(cls, guild_id: int, character_id: ObjectId) -> AggregationQuery:
+        """Scenes the character appears in, ordered by chapter and scene number, as rows with their chapter"""
+        pipeline = [
+            {"$match": {"guild_id": guild_id, "characters.$id": character_id}},
+            {"$project": {"name": 1, "number": 1, "chapter_id": link_id_field("chapter")}},
+            {"$lookup": {"from": Chapter.get_motor_collection().name, "localField": "chapter_id",
+                         "foreignField": "_id", "pipeline": [{"$project": {"name": 1, "number": 1}}],
+                         "as": "chapters"}},
+            {"$project": {"name": 1, "number": 1, "chapter_name": {"$first": "$chapters.name"},
+                          "chapter_number": {"$first": "$chapters.number"}}},
+            {"$sort": {"chapter_number": 1, "number": 1}},
+        ]
+        return AggregationQuery(cls, pipeline, record=FeaturedSceneRow)
+
+    @classmethod
+    async def remove_character_everywhere(cls, guild_id: int, character_id: ObjectId) -> int:
+        """Removes the character from all scenes in a single indexed write, returns amount of changed scenes"""
+        link = DBRef(Character.get_motor_collection().name, character_id)
+        result = await cls.get_motor_collection().update_many(
+            {"guild_id": guild_id, "characters.$id": character_id},
+            {"$pull": {"characters": link}},
+        )
+
+        index = NameIndex.of(cls)
+        for entry in list(index.guilds.get(guild_id, {}).values()):
+            if character_id in entry.character_ids:
+                index.modify(guild_id, entry.id, character_ids=entry.character_ids - {character_id})
+        return result.modified_count
+
+    @classmethod
+    async def chapter_ids(cls, guild_id: int) -> set[ObjectId]:
+        """Ids of chapters that have at least one scene, from scene counts the name index keeps per chapter"""
+        return set(await NameIndex.of(cls).counted(guild_id))
+
+    @classmethod
+    def in_chapter(cls, guild_id: int, chapter_id):
+        return cls.find({"guild_id": guild_id, "chapter.$id": chapter_id})
+
+    @classmethod
+    async def chapter_summaries(cls, guild_id: int, chapter_ids: list[ObjectId] | None = None,
+                                with_scenes: bool = False) -> dict[ObjectId, dict]:
+        """Scene count (and, optionally, scenes ordered by number) for every chapter, in a single aggregation"""
+        match = {"guild_id": guild_id}
+        if chapter_ids is not None:
+            match["chapter.$id"] = {"$in": chapter_ids}
+
+        group = {"_id": link_id_field("chapter"), "count": {"$sum": 1}}
+        if with_scenes:
+            group["scenes"] = {"$push": {"number": "$number", "name": "$name"}}
+
+        pipeline = [{"$match": match}, {"$sort": {"number": 1}}, {"$group": group}]
+        results = await cls.aggregate(pipeline).to_list()
+        return {result["_id"]: result for result in results}
 
     @classmethod
     async def fuzzy_find(cls, chapter: "Chapter", query: str) -> "Scene":
+        return await cls.fuzzy_find_in(chapter.guild_id, chapter.id, query)
+
+    @classmethod
+    async def fuzzy_find_in(cls, guild_id: int, chapter_id: ObjectId, query: str) -> "Scene":
+        names = await cls.names(guild_id, where=lambda entry: entry.chapter_id == chapter_id)
         try:
-            return await fuzzy_find_obj(query, cls.in_chapter(chapter.id))
+            return await fuzzy_find_obj(query, cls.in_chapter(guild_id, chapter_id), names)
         except ValueError:
             raise InvalidArgument(f"Chapter with name'**{query}**' not found!")
 
+    @classmethod
+    async def resolve(cls, ctx: InteractionContext, chapter: "Chapter", query: str) -> "Scene":
+        return await resolve_option(ctx, cls, chapter.id, query, lambda: cls.fuzzy_find(chapter, query))
+
+    @classmethod
+    async def resolve_entry(cls, ctx: InteractionContext, chapter: ChapterEntry, query: str) -> SceneEntry:
+        guild_id = get_guild_id(ctx)
+        return await resolve_option_entry(ctx, cls, guild_id, chapter.id, query,
+                                          lambda: cls.fuzzy_find_in(guild_id, chapter.id, query))
+
     @property
     def fullname(self):
         return f"{self.number}. {self.name}"
@@ -1,17 +1,21 @@
+import time
+import asyncio
 import traceback
 import logging
 from typing import TYPE_CHECKING
+from collections import defaultdict, deque
 from datetime import datetime, timedelta
 
 import naff
 import pytz
-import beanie
+import pymongo
 from naff import slash_str_option, slash_channel_option, slash_bool_option
 from naff import InteractionContext, AutocompleteContext
 
 from utils.exceptions import InvalidArgument
 from utils.commands import manage_cmd
 from utils.db import Document
+from utils.startup import readiness, stage
 
 if TYPE_CHECKING:
     from extensions.timezone import TimezoneCmd
@@ -30,12 +34,14 @@ class ClockBarChannel(Document):
     show_timezone: bool = True
     h24: bool = True
 
-    @beanie.before_event(beanie.ValidateOnSave)
-    async def validate_db(self):
-        # validate name
-        cls = self.__class__
-        if await cls.find(cls.channel_id == self.channel_id, cls.id != self.id).exists():
-            raise InvalidArgument(f"Clock bar for channel `{self.channel_id}` already exists!")
+    class Settings:
+        validate_on_save = True
+        indexes = [
+            pymongo.IndexModel("channel_id", unique=True, name="channel_id_1_unique"),
+        ]
+
+    def duplicate_message(self) -> str:
+        return f"Clock bar for channel `{self.channel_id}` already exists!"
 
     async def channel(self, bot: naff.Client) -> naff.GuildChannel:
         return await bot.fetch_channel(self.channel_id)
@@ -56,42 +62,116 @@ class MinuteIntervalTrigger(naff.BaseTrigger):
         if (datetime.now() + self.delta) < datetime.now():
             raise ValueError("Interval values must result in a time in the future!")
 
+    def slot(self, t: datetime) -> datetime:
+        """Start of the interval slot `t` belongs to"""
+        return datetime(t.year, t.month, t.day, t.hour, t.minute - t.minute % self.delta_minutes)
+
     def next_fire(self) -> datetime:
-        t = self.last_call_time + self.delta
-        t = datetime(t.year, t.month, t.day, t.hour, t.minute - t.minute % self.delta_minutes, 5)
-        return t
+        # Clock bar names are rendered ahead of time, so we fire right on the slot boundary
+        return self.slot(self.last_call_time) + self.delta
+
+
+class RenameBuckets:
+    """
+    Tracks channel renames, Discord allows only 2 of them per 10 minutes per channel.
+    """
+
+    def __init__(self, limit: int = 2, period: float = 10 * 60):
+        self.limit = limit
+        self.period = period
+        self.renames: defaultdict[int, deque] = defaultdict(deque)
+
+    def available(self, channel_id: int) -> bool:
+        renames = self.renames[channel_id]
+        now = time.monotonic()
+        while renames and renames[0] <= now - self.period:
+            renames.popleft()
+        return len(renames) < self.limit
+
+    def record(self, channel_id: int):
+        self.renames[channel_id].append(time.monotonic())
+
+    def discard(self, channel_id: int):
+        self.renames.pop(channel_id, None)
 
 
 class InfoBarCmd(naff.Extension):
     def __init__(self, client):
-        self.clock_bars = list()
+        self.clock_bars: dict[int, ClockBarChannel] = {}  # channel_id -> clock bar
+        self.clock_bars_touched: set[int] | None = None  # created or forgotten while a reconcile reads the db
         self.clock_bar_task = None
+        self.clock_bar_reconcile_task = None
+        self.clock_bar_reconcile_hours = 1
+        self.clock_bar_trigger = None
         self.clock_bar_minutes = 10
+        self.clock_bar_concurrency = 8
+
+        self.clock_bar_names: dict[int, str] = {}  # channel_id -> last name we've set
+        self.next_clock_bar_names: tuple[datetime, dict[int, str]] | None = None  # pre-rendered for the next slot
+        self.rename_buckets = RenameBuckets()
 
     @naff.listen()
     async def on_startup(self, *args, **kwargs):
+        self.clock_bar_trigger = MinuteIntervalTrigger(minutes=self.clock_bar_minutes)
         self.clock_bar_task = naff.Task(
             self._update_clock_bar_task,
-            MinuteIntervalTrigger(minutes=self.clock_bar_minutes),
+            self.clock_bar_trigger,
+        )
+        # The registry is updated in place on create/remove, reloading it only catches changes made outside the bot
+        self.clock_bar_reconcile_task = naff.Task(
+            self._reconcile_clock_bars,
+            naff.IntervalTrigger(hours=self.clock_bar_reconcile_hours),
         )
-        await self._refresh_clock_bars_cache()
+        await readiness.wait("database")
+        with stage("clock bars"):
+            await self._reconcile_clock_bars()
         # await self._update_clock_bar_task()
         self.clock_bar_task.start()
+        self.clock_bar_reconcile_task.start()
 
     async def _update_clock_bar_task(self):
-        for clock_bar in self.clock_bars.copy():
-            try:
-                await self._update_clock_bar(clock_bar)
-            except InvalidArgument as e:
-                embed = naff.Embed(color=naff.MaterialColors.RED)
-                embed.description = str(e)
-                guild = await self.bot.fetch_guild(clock_bar.guild_id)
-                await guild.system_channel.send(embed=embed)
-
-    async def _update_clock_bar(self, clock_bar: ClockBarChannel):
+        clock_bars = list(self.clock_bars.values())
+        slot = self.clock_bar_trigger.slot(datetime.now())
+        names = {}
+        if self.next_clock_bar_names is not None and self.next_clock_bar_names[0] == slot:
+            names = self.next_clock_bar_names[1]
+        missing = [clock_bar for clock_bar in clock_bars if clock_bar.channel_id not in names]
+        names = names | self._render_clock_bar_names(missing, slot)
+
+        semaphore = asyncio.Semaphore(self.clock_bar_concurrency)
+
+        async def update(clock_bar: ClockBarChannel):
+            async with semaphore:
+                try:
+                    await self._update_clock_bar(clock_bar, names[clock_bar.channel_id])
+                except InvalidArgument as e:
+                    embed = naff.Embed(color=naff.MaterialColors.RED)
+                    embed.description = str(e)
+                    guild = await self.bot.fetch_guild(clock_bar.guild_id)
+                    await guild.system_channel.send(embed=embed)
+
+        results = await asyncio.gather(*(update(clock_bar) for clock_bar in clock_bars), return_exceptions=True)
+        for clock_bar, result in zip(clock_bars, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Could not update clock bar {clock_bar}: {result}")
+
+        next_slot = slot + self.clock_bar_trigger.delta
+        self.next_clock_bar_names = next_slot, self._render_clock_bar_names(list(self.clock_bars.values()), next_slot)
+
+    async def _update_clock_bar(self, clock_bar: ClockBarChannel, name: str | None = None):
+        name = name or self._get_clock_bar_name(clock_bar)
+        if self.clock_bar_names.get(clock_bar.channel_id) == name:
+            return
+        if not self.rename_buckets.available(clock_bar.channel_id):
+            logger.debug(f"Skipping clock bar update for channel {clock_bar.channel_id}, renamed too often")
+            return
+
         channel = await clock_bar.channel(self.bot)
         try:
-            await channel.edit(name=self._get_clock_bar_name(clock_bar))
+            if channel.name != name:
+                self.rename_buckets.record(clock_bar.channel_id)
+                await channel.edit(name=name)
+            self.clock_bar_names[clock_bar.channel_id] = name
         except naff.errors.TooManyChanges:
             # rate limited
             pass
@@ -99,12 +179,8 @@ class InfoBarCmd(naff.Extension):
             logger.warning(
                 f"Could not edit channel {channel} name for clock bar {clock_bar} in {channel.guild}, removing it: {e}")
             traceback.print_exc()
-            try:
-                self.clock_bars.remove(clock_bar)
-            except ValueError:
-                pass
+            self._forget_clock_bar(clock_bar.channel_id)
             await clock_bar.delete()
-            await self._refresh_clock_bars_cache()
 
             channel = channel.mention if channel is not None else f"`{clock_bar.channel_id}`"
             raise InvalidArgument(
@@ -113,16 +189,51 @@ class InfoBarCmd(naff.Extension):
                 f"Anyway, I won't be updating it."
             )
 
-    async def _refresh_clock_bars_cache(self):
-        self.clock_bars = await ClockBarChannel.all().to_list()
+    def _forget_clock_bar(self, channel_id: int):
+        # Creating a clock bar forgets the old one first, so this also records creations for the reconcile
+        if self.clock_bars_touched is not None:
+            self.clock_bars_touched.add(channel_id)
+        self.clock_bars.pop(channel_id, None)
+        self.clock_bar_names.pop(channel_id, None)
+        self.rename_buckets.discard(channel_id)
+        if self.next_clock_bar_names is not None:
+            self.next_clock_bar_names[1].pop(channel_id, None)
+
+    async def _reconcile_clock_bars(self):
+        if self.clock_bars_touched is not None:  # already reconciling
+            return
+        self.clock_bars_touched = set()
+        try:
+            clock_bars = await ClockBarChannel.all().to_list()
+        finally:
+            touched, self.clock_bars_touched = self.clock_bars_touched, None
+
+        # Bars created or removed while reading are newer than the snapshot, so their in-memory state wins
+        registry = {clock_bar.channel_id: clock_bar for clock_bar in clock_bars if clock_bar.channel_id not in touched}
+        registry.update({channel_id: clock_bar for channel_id, clock_bar in self.clock_bars.items()
+                         if channel_id in touched})
+        self.clock_bars = registry
+
+    @classmethod
+    def _get_clock_bar_name(cls, clock_bar: ClockBarChannel):
+        return cls._render_clock_bar_names([clock_bar], datetime.now())[clock_bar.channel_id]
 
     @staticmethod
-    def _get_clock_bar_name(clock_bar: ClockBarChannel):
-        timezone = pytz.timezone(clock_bar.timezone)
-        now = datetime.now(timezone)
-        abbreviation = now.strftime("%Z") if clock_bar.show_timezone else ""
-        time_str = now.strftime("%H:%M") if clock_bar.h24 else now.strftime("%I:%M %p")
-        return f"{clock_bar.prefix} {time_str} {abbreviation} {clock_bar.postfix}"
+    def _render_clock_bar_names(clock_bars: list[ClockBarChannel], at: datetime) -> dict[int, str]:
+        # Many bars share a timezone and format, so the time is formatted once per such group
+        groups = defaultdict(list)
+        for clock_bar in clock_bars:
+            groups[(clock_bar.timezone, clock_bar.h24, clock_bar.show_timezone)].append(clock_bar)
+
+        at = at.astimezone()  # naive local time -> aware
+        names = {}
+        for (timezone, h24, show_timezone), group in groups.items():
+            now = at.astimezone(pytz.timezone(timezone))
+            abbreviation = now.strftime("%Z") if show_timezone else ""
+            time_str = now.strftime("%H:%M") if h24 else now.strftime("%I:%M %p")
+            for clock_bar in group:
+                names[clock_bar.channel_id] = f"{clock_bar.prefix} {time_str} {abbreviation} {clock_bar.postfix}"
+        return names
 
     @info_bar_cmd.subcommand("create_clock")
     async def clock_create(
@@ -147,8 +258,9 @@ class InfoBarCmd(naff.Extension):
             h24=h24,
         )
         await clock_bar.save()
+        self._forget_clock_bar(clock_bar.channel_id)
+        self.clock_bars[clock_bar.channel_id] = clock_bar
         await self._update_clock_bar(clock_bar)
-        await self._refresh_clock_bars_cache()
 
         channel = await clock_bar.channel(self.bot)
         embed = naff.Embed(color=naff.MaterialColors.GREEN)
@@ -167,12 +279,12 @@ class InfoBarCmd(naff.Extension):
     ):
         """Removes clock bar (not channel itself) and stops all the updates"""
         await ctx.defer(ephemeral=True)
-        clock_bar = ClockBarChannel.find({"channel_id": channel.id}).first_or_none()
+        clock_bar = await ClockBarChannel.find({"channel_id": channel.id}).first_or_none()
         if clock_bar is None:
             raise InvalidArgument(f"Channel {channel.mention} is not associated with any clock bar!")
 
         await clock_bar.delete()
-        await self._refresh_clock_bars_cache()
+        self._forget_clock_bar(clock_bar.channel_id)
 
         embed = naff.Embed(color=naff.MaterialColors.DEEP_ORANGE)
         embed.description = f"Removed clock bar from channel {channel.mention}"
@@ -0,0 +1,18 @@
+import naff
+
+from utils.pagination import Paginator
+from utils.startup import readiness
+
+
+class PaginationCmd(naff.Extension):
+    @naff.listen()
+    async def on_component(self, event: naff.events.Component):
+        if event.context.custom_id not in (Paginator.prev_id, Paginator.next_id):
+            return
+        # Components can arrive while the database is still being initialized
+        await readiness.wait("database")
+        await Paginator.navigate(event.context)
+
+
+def setup(bot):
+    PaginationCmd(bot)
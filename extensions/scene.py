@@ -1,15 +1,19 @@
 from typing import TYPE_CHECKING
+from operator import attrgetter
 import naff
 from naff import slash_str_option, slash_int_option
 from naff import InteractionContext, AutocompleteContext, Permissions
 from naff.client.utils import TTLCache
 from bson import ObjectId
 
+from utils.db import NumberedNameRecord
 from utils.fuzz import fuzzy_autocomplete
 from utils.intractions import yes_no
 from utils.exceptions import InvalidArgument
-from utils.text import make_table, format_entry, pluralize
-from utils.commands import manage_cmd, list_cmd, info_cmd, generic_rename, generic_move, generic_autocomplete
+from utils.text import make_table, format_entry, join_lines, pluralize
+from utils.pagination import Paginator, numbered_entries
+from utils.autocomplete import coalesce_autocomplete
+from utils.commands import get_guild_id, manage_cmd, list_cmd, info_cmd, generic_rename, generic_move, generic_autocomplete
 
 from extensions.character_models import Character, Scene, Chapter
 
@@ -43,8 +47,8 @@ class SceneCmd(naff.Extension):
     ):
         """Adds a scene to the chapter"""
         await ctx.defer(ephemeral=True)
-        chapter_obj = await Chapter.fuzzy_find(chapter)
-        scene_obj = Scene(name=name, chapter=chapter_obj)
+        chapter_obj = await Chapter.resolve(ctx, chapter)
+        scene_obj = Scene(guild_id=chapter_obj.guild_id, name=name, chapter=chapter_obj)
         await scene_obj.save()
         self.set_last_scene(ctx, chapter_obj, scene_obj)
 
@@ -66,8 +70,8 @@ class SceneCmd(naff.Extension):
     ):
         """Removes a scene from the chapter"""
         await ctx.defer(ephemeral=True)
-        chapter_obj = await Chapter.fuzzy_find(chapter)
-        scene_obj = await Scene.fuzzy_find(chapter_obj, scene)
+        chapter_obj = await Chapter.resolve(ctx, chapter)
+        scene_obj = await Scene.resolve(ctx, chapter_obj, scene)
         await scene_obj.delete()
         self.clear_last_scene(ctx)
 
@@ -94,8 +98,8 @@ class SceneCmd(naff.Extension):
     ):
         """Renames a scene"""
         await ctx.defer(ephemeral=True)
-        chapter_obj = await Chapter.fuzzy_find(chapter)
-        scene_obj = await Scene.fuzzy_find(chapter_obj, scene)
+        chapter_obj = await Chapter.resolve(ctx, chapter)
+        scene_obj = await Scene.resolve(ctx, chapter_obj, scene)
         self.set_last_scene(ctx, chapter_obj, scene_obj)
 
         embed = await generic_rename(scene_obj, "scene", new_name)
@@ -120,8 +124,8 @@ class SceneCmd(naff.Extension):
     ):
         """Changes a position (number) of the scene in a chapter"""
         await ctx.defer(ephemeral=True)
-        chapter_obj = await Chapter.fuzzy_find(chapter)
-        scene_obj = await Scene.fuzzy_find(chapter_obj, scene)
+        chapter_obj = await Chapter.resolve(ctx, chapter)
+        scene_obj = await Scene.resolve(ctx, chapter_obj, scene)
         self.set_last_scene(ctx, chapter_obj, scene_obj)
 
         embed = await generic_move(scene_obj, "scene", new_position)
@@ -147,21 +151,18 @@ class SceneCmd(naff.Extension):
         """Adds a character to the scene"""
         # noinspection DuplicatedCode
         await ctx.defer(ephemeral=True)
-        chapter_obj = await Chapter.fuzzy_find(chapter)
-        scene_obj = await Scene.fuzzy_find(chapter_obj, scene)
-        character_obj = await Character.fuzzy_find(character)
+        chapter_obj = await Chapter.resolve(ctx, chapter)
+        scene_obj = await Scene.resolve(ctx, chapter_obj, scene)
+        character_obj = await Character.fuzzy_find(get_guild_id(ctx), character)
         self.set_last_scene(ctx, chapter_obj, scene_obj)
 
         embed = naff.Embed()
-        id_exists = [True for instance in scene_obj.characters if character_obj.id == instance.ref.id]
-        if id_exists:
+        if not await scene_obj.add_character(character_obj.id):
             embed.color = naff.MaterialColors.PURPLE
             embed.description = f"Character '**{character_obj.name}**' is already in the scene '**{scene_obj.name}**' " \
                                 f"of chapter '**{chapter_obj.name}**'"
         else:
             embed.color = naff.MaterialColors.INDIGO
-            scene_obj.characters.append(Character.link_from_id(character_obj.id))
-            await scene_obj.save()
             embed.description = f"Added character '**{character_obj.name}**' to the scene '**{scene_obj.name}**' " \
                                 f"of chapter '**{chapter_obj.name}**'"
         embed.fields.append(await self.scene_characters_field(ctx, chapter_obj, scene_obj))
@@ -178,9 +179,9 @@ class SceneCmd(naff.Extension):
     @scene_add_character.autocomplete("character")
     async def add_character_autocomplete_character(self, ctx: AutocompleteContext,
                                                    chapter: str, scene: str, character: str, **_):
-        chapter_obj = await Chapter.fuzzy_find(chapter)
-        scene_obj = await Scene.fuzzy_find(chapter_obj, scene)
-        return await self.character_ext.character_autocomplete(ctx, character, exclude_scene=scene_obj)
+        chapter_entry = await Chapter.resolve_entry(ctx, chapter)
+        scene_entry = await Scene.resolve_entry(ctx, chapter_entry, scene)
+        return await self.character_ext.character_autocomplete(ctx, character, exclude_scene=scene_entry)
 
     @scene_cmd.subcommand("remove_character")
     async def scene_remove_character(
@@ -194,21 +195,18 @@ class SceneCmd(naff.Extension):
         """Removes a character from the scene"""
         # noinspection DuplicatedCode
         await ctx.defer(ephemeral=True)
-        chapter_obj = await Chapter.fuzzy_find(chapter)
-        scene_obj = await Scene.fuzzy_find(chapter_obj, scene)
-        character_obj = await Character.fuzzy_find(character)
+        chapter_obj = await Chapter.resolve(ctx, chapter)
+        scene_obj = await Scene.resolve(ctx, chapter_obj, scene)
+        character_obj = await Character.fuzzy_find(get_guild_id(ctx), character)
         self.set_last_scene(ctx, chapter_obj, scene_obj)
 
         embed = naff.Embed()
-        new_characters = [instance for instance in scene_obj.characters if character_obj.id != instance.ref.id]
-        if new_characters == scene_obj.characters:
+        if not await scene_obj.remove_character(character_obj.id):
             embed.color = naff.MaterialColors.PURPLE
             embed.description = f"Character '**{character_obj.name}**' is *not* in the scene '**{scene_obj.name}**' " \
                                 f"of chapter '**{chapter_obj.name}**'"
         else:
             embed.color = naff.MaterialColors.INDIGO
-            scene_obj.characters = new_characters
-            await scene_obj.save()
             embed.description = f"Removed character '**{character_obj.name}**' from the scene '**{scene_obj.name}**' " \
                                 f"of chapter '**{chapter_obj.name}**'"
         embed.fields.append(await self.scene_characters_field(ctx, chapter_obj, scene_obj))
@@ -225,9 +223,9 @@ class SceneCmd(naff.Extension):
     @scene_remove_character.autocomplete("character")
     async def remove_character_autocomplete_character(self, ctx: AutocompleteContext,
                                                       chapter: str, scene: str, character: str, **_):
-        chapter_obj = await Chapter.fuzzy_find(chapter)
-        scene_obj = await Scene.fuzzy_find(chapter_obj, scene)
-        return await self.character_ext.character_autocomplete(ctx, character, only_scene=scene_obj)
+        chapter_entry = await Chapter.resolve_entry(ctx, chapter)
+        scene_entry = await Scene.resolve_entry(ctx, chapter_entry, scene)
+        return await self.character_ext.character_autocomplete(ctx, character, only_scene=scene_entry)
 
     @list_cmd.subcommand("scenes")
     async def scene_list(self, ctx: InteractionContext,
@@ -235,12 +233,20 @@ class SceneCmd(naff.Extension):
                          ):
         """List all scenes in specified chapter"""
         await ctx.defer(ephemeral=True)
-        chapter_obj = await Chapter.fuzzy_find(chapter)
+        chapter_obj = await Chapter.resolve(ctx, chapter)
+        total = await Scene.in_chapter(chapter_obj.guild_id, chapter_obj.id).count()
 
-        embed = naff.Embed(color=naff.MaterialColors.LIGHT_BLUE)
-        embed.title = f"Scenes list"
-        embed.fields.append(await self.scenes_field(chapter_obj))
-        await ctx.send(embed=embed)
+        async def render(scenes: list[NumberedNameRecord], paginator: Paginator):
+            embed = naff.Embed(color=naff.MaterialColors.LIGHT_BLUE)
+            embed.title = f"Scenes list"
+            embed.add_field(
+                name=f"Scenes in '{chapter_obj.name}' chapter [{total} total]:",
+                value=join_lines([format_entry(scene) for scene in scenes]) or "No scenes!",
+            )
+            return embed
+
+        query = Scene.in_chapter(chapter_obj.guild_id, chapter_obj.id).sort("+number")
+        await Paginator(query, render, record=NumberedNameRecord).send(ctx)
 
     @scene_list.autocomplete("chapter")
     async def scene_list_autocomplete_chapter(self, ctx: AutocompleteContext, chapter: str, **_):
@@ -254,42 +260,46 @@ class SceneCmd(naff.Extension):
     def chapter_ext(self) -> "ChapterCmd":
         return self.bot.get_ext("ChapterCmd")  # type: ignore
 
+    @coalesce_autocomplete
     async def scene_autocomplete(self, ctx: AutocompleteContext, chapter: str, query: str,
                                  only_wth_characters: bool = False):
-        chapter_obj = await Chapter.fuzzy_find(chapter)
-        if chapter_obj.id != self.chapter_ext.get_last_chapter(ctx):
+        chapter_entry = await Chapter.resolve_entry(ctx, chapter)
+        if chapter_entry.id != self.chapter_ext.get_last_chapter(ctx):
             self.clear_last_scene(ctx)
 
-        db_query = Scene.in_chapter(chapter_obj.id).sort("+number")
-        if only_wth_characters:
-            db_query = db_query.find({"characters": {"$exists": True, "$not": {"$size": 0}}})
+        def where(entry):
+            if entry.chapter_id != chapter_entry.id:
+                return False
+            return bool(entry.character_ids) or not only_wth_characters
 
         last_scene_id = self.get_last_scene(ctx)
 
-        results = await generic_autocomplete(query, db_query, last_scene_id, use_numbers=True)
-        results = [{"name": f"{scene.number}. {scene.name}", "value": scene.name} for scene in results]
-        await ctx.send(results)
+        results = await generic_autocomplete(query, Scene, get_guild_id(ctx), last_scene_id, use_numbers=True,
+                                             where=where, sort_key=attrgetter("number"))
+        return [{"name": f"{scene.number}. {scene.name}", "value": scene.name} for scene in results]
 
     @classmethod
     async def scenes_field(cls, chapter, highlight=None):
-        scenes = await Scene.in_chapter(chapter.id).sort("+number").to_list()
+        scenes_text, total = await numbered_entries(Scene.in_chapter(chapter.guild_id, chapter.id), highlight)
 
         field = naff.EmbedField(
-            name=f"Scenes in '{chapter.name}' chapter [{len(scenes)} total]:",
-            value="\n".join([format_entry(scene, highlight) for scene in scenes])
+            name=f"Scenes in '{chapter.name}' chapter [{total} total]:",
+            value=scenes_text or "No scenes!",
         )
 
         return field
 
     async def scene_characters_field(self, ctx, chapter: Chapter, scene: Scene):
-        description, characters_text, characters = await self.character_ext.make_character_list(
+        description, db_query, make_text = await self.character_ext.make_character_list(
             ctx=ctx,
             chapter=chapter,
             scene=scene,
         )
+        # Scene characters are bounded by the scene itself, the text is truncated to fit the field if needed
+        characters = await db_query.to_list()
         field = naff.EmbedField(
             name=f"Characters in '{scene.name}' scene [{len(characters)} total]:",
-            value=characters_text or "No characters available!"
+            value=await make_text(characters) or "No characters available!"
         )
 
         return field
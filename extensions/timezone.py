@@ -1,11 +1,10 @@
 import re
-
 import time
+import string
+import asyncio
+import functools
 
-import dateparser
 import pytz
-from dateparser.date import DateDataParser
-from dateparser.search import search_dates
 
 from datetime import datetime
 
@@ -15,13 +14,17 @@ from dateutil.relativedelta import relativedelta
 
 from naff import SlashCommand, SlashCommandChoice, slash_str_option, slash_user_option, context_menu
 from naff import InteractionContext, AutocompleteContext
-from collections import defaultdict
+from naff.client.utils import TTLCache
 
 from utils.fuzz import fuzzy_autocomplete
 from utils.exceptions import InvalidArgument
 from utils.db import Document
+from utils.timezones import TimezoneCatalogue
+from utils.dates import DateParserPool
 from utils.text import make_table, format_delta, clock_emojis
 from utils.commands import manage_cmd
+from utils.autocomplete import coalesce_autocomplete
+from utils.startup import NotReady, readiness, stage
 
 timezone_cmd = SlashCommand(name="timezone")
 time_cmd = SlashCommand(name="time")
@@ -30,10 +33,30 @@ manage_timezone_cmd = manage_cmd.group("timezone")
 timezone_styles = [SlashCommandChoice(item.name, item.name) for item in naff.TimestampStyles]
 
 
+# user_id -> UserTimezone, or None for users without a timezone
+user_timezones_cache = TTLCache(ttl=60 * 60, soft_limit=1000, hard_limit=5000)
+
+
 class UserTimezone(Document):
-    user_id: int
+    user_id: beanie.Indexed(int)
     timezone: str
 
+    @beanie.after_event([beanie.Insert, beanie.Replace])
+    async def cache_timezone(self):
+        user_timezones_cache[self.user_id] = self
+
+    @beanie.after_event(beanie.Delete)
+    async def uncache_timezone(self):
+        user_timezones_cache[self.user_id] = None
+
+    @classmethod
+    async def get_cached(cls, user_id: int) -> "UserTimezone | None":
+        user_timezone = user_timezones_cache.get(user_id, naff.MISSING)
+        if user_timezone is naff.MISSING:
+            user_timezone = await cls.find_one({"user_id": user_id})
+            user_timezones_cache[user_id] = user_timezone
+        return user_timezone
+
     @property
     def now(self):
         return datetime.now(pytz.timezone(self.timezone))
@@ -68,7 +91,7 @@ class UserTimezone(Document):
 
     @classmethod
     async def from_member(cls, member: naff.Member, you=False) -> "UserTimezone":
-        user_timezone = await cls.find({"user_id": member.id}).first_or_none()
+        user_timezone = await cls.get_cached(member.id)
         if not user_timezone:
             if you:
                 raise InvalidArgument("You don't have a timezone set up!\n"
@@ -82,39 +105,75 @@ class TimezoneCmd(naff.Extension):
     def __init__(self, client):
         # timezones
         self.timezones = pytz.all_timezones
+        self.catalogue = TimezoneCatalogue(client.current_dir / "cache" / "timezones.json")
+        self.catalogue_task: asyncio.Task | None = None
+        self.warm_up_task: asyncio.Task | None = None
+
+        # results of get_timezone_results and popular timezones, valid for one generation of catalogue tables
+        self.results_generation = None
+        self.results_cache = TTLCache(ttl=60 * 60, soft_limit=500, hard_limit=1000)
+        # queries up to two characters are typed by almost everyone, so they are kept much longer
+        self.prefix_results = TTLCache(ttl=24 * 60 * 60, soft_limit=1000, hard_limit=2000)
+        self.popular_timezones: list[str] | None = None
+
+        self.date_parser = DateParserPool()
+        # (normalized query, minute) -> parsed datetime, relative times like "in 5 minutes" only shift once a minute
+        self.parsed_times = TTLCache(ttl=2 * 60, soft_limit=500, hard_limit=1000)
+
+    def drop(self):
+        if self.catalogue_task is not None:
+            self.catalogue_task.cancel()
+        if self.warm_up_task is not None:
+            self.warm_up_task.cancel()
+        self.date_parser.shutdown()
+        super().drop()
 
-        self.abbreviations: defaultdict[str, list] = defaultdict(list)
-        self.offsets: defaultdict[str, list] = defaultdict(list)
-
-        for name in self.timezones:
-            timezone = pytz.timezone(name)
-            now = datetime.now(timezone)
-
-            abbreviation = now.strftime("%Z")
-            self.abbreviations[abbreviation].append(name)
+    @property
+    def abbreviations(self) -> dict[str, list]:
+        self.catalogue.load()
+        return self.catalogue.abbreviations
 
-            offset_variations = self._offset_variations(now)
-            for offset in offset_variations:
-                self.offsets[offset].append(name)
+    @property
+    def offsets(self) -> dict[str, list]:
+        self.catalogue.load()
+        return self.catalogue.offsets
 
-    @staticmethod
-    def _offset_variations(now):
-        offset = now.strftime("%z")
-        sign, hours, minutes = offset[0], int(offset[1:3]), int(offset[3:])
-        sign_variants = ["", "+"] if sign == "+" else ["-"]
-        minutes_variants = ["", f"{minutes}"]
-        v2 = f"{hours}"
-        results = []
-        for v1 in sign_variants:
-            for v3 in minutes_variants:
-                results.append(v1 + v2 + v3)
-        return results
+    @naff.listen()
+    async def on_startup(self, *args, **kwargs):
+        self.catalogue_task = asyncio.create_task(self._refresh_catalogue_task())
+        self.warm_up_task = asyncio.create_task(self._warm_up_date_parser())
+
+    async def _warm_up_date_parser(self):
+        with stage("date parser"):
+            await self.date_parser.warm_up()
+
+    async def _refresh_catalogue_task(self):
+        with stage("timezone catalogue", gate="timezones"):
+            await asyncio.to_thread(self._warm_up_results)
+        # Sleep until the closest DST/offset change of any timezone, then update affected zones only
+        while True:
+            next_transition = self.catalogue.next_transition
+            if next_transition is None:
+                return
+            await asyncio.sleep(max(next_transition - time.time(), 0) + 1)
+            self.catalogue.refresh()
+
+    def _warm_up_results(self):
+        self.catalogue.load()
+        for prefix in string.ascii_lowercase + string.digits + "+-":
+            self.get_timezone_results(prefix)
 
     @classmethod
     def format_timezone(cls, name):
+        # Labels only change once a minute, so they are cached per minute
+        return cls._format_timezone(name, int(time.time() // 60))
+
+    @staticmethod
+    @functools.lru_cache(maxsize=2048)
+    def _format_timezone(name, minute):
         timezone = pytz.timezone(name)
         now = datetime.now(timezone)
-        offset = cls.format_offset(now)
+        offset = TimezoneCmd.format_offset(now)
         abbreviation = now.strftime("%Z")
         return f"{offset} | {abbreviation} | {name} | {now.strftime('%H:%M')}"
 
@@ -301,7 +360,7 @@ class TimezoneCmd(naff.Extension):
     async def time_message_context(self, ctx: InteractionContext):
         message: naff.Message = ctx.target
         user_timezone = await UserTimezone.from_member(message.author)
-        embed = self.generic_datetime_detect(message, user_timezone)
+        embed = await self.generic_datetime_detect(message, user_timezone)
 
         await ctx.send(embed=embed)
 
@@ -315,6 +374,7 @@ class TimezoneCmd(naff.Extension):
     async def on_message_reaction_add(self, event: naff.events.MessageReactionAdd):
         if event.emoji.name not in clock_emojis:
             return
+        await readiness.wait("database")
         message = event.message
         count = sum(reaction.count for reaction in message.reactions if reaction.emoji.name in clock_emojis)
         if count != 1:
@@ -322,7 +382,7 @@ class TimezoneCmd(naff.Extension):
 
         try:
             user_timezone = await UserTimezone.from_member(message.author)
-            embed = self.generic_datetime_detect(message, user_timezone, add_quote=False)
+            embed = await self.generic_datetime_detect(message, user_timezone, add_quote=False)
         except InvalidArgument as e:
             embed = naff.Embed(color=naff.MaterialColors.RED)
             embed.description = str(e)[:2000]
@@ -330,8 +390,7 @@ class TimezoneCmd(naff.Extension):
         else:
             await message.reply(embed=embed, allowed_mentions=naff.AllowedMentions.none())
 
-    @staticmethod
-    def generic_datetime_detect(message: naff.Message, user_timezone: UserTimezone, add_quote=True):
+    async def generic_datetime_detect(self, message: naff.Message, user_timezone: UserTimezone, add_quote=True):
         to_detect = message.content.replace("*", "")
         to_detect = to_detect.strip()
 
@@ -341,25 +400,12 @@ class TimezoneCmd(naff.Extension):
         languages = ["en"]
 
         try:
-            detected = search_dates(to_detect, settings=settings, languages=languages)
+            detected = await self.date_parser.detect_dates(to_detect, settings, languages)
         except ValueError:
             raise InvalidArgument("Cannot detect language of the message or it is unsupported!")
 
-        if detected is None:
-            # sanity check because somtimes search_dates does not get datetime if it is not surrounded by anything
-            parsed = dateparser.parse(to_detect, settings=settings, languages=languages)
-            if parsed is None:
-                raise InvalidArgument("No dates nor times were detected in the message!")
-            detected = [(to_detect, parsed)]
-        else:
-            def process(chunk: str, t: datetime):
-                # sanity check because somtimes search_dates gets AM as months etc
-                parsed = dateparser.parse(chunk, settings=settings, languages=languages)
-                if parsed is not None and parsed != t:
-                    return chunk, parsed
-                return chunk, t
-
-            detected = [process(chunk, t) for chunk, t in detected]
+        if not detected:
+            raise InvalidArgument("No dates nor times were detected in the message!")
 
         def localize(t: datetime):
             # sometimes user can explicitly specify time in the message
@@ -420,9 +466,18 @@ class TimezoneCmd(naff.Extension):
 
         return field
 
+    async def wait_for_catalogue(self):
+        # During startup the catalogue and result caches are filled in a thread, searching them here at the same
+        # time would race on the caches (and block the loop on the catalogue lock)
+        try:
+            await readiness.wait("timezones")
+        except NotReady:
+            pass  # warm-up failed, the catalogue gets loaded on demand instead
+
     async def set_user_timezone(self, user_id: int, timezone_name: str):
+        await self.wait_for_catalogue()
         timezone = self.get_timezone(timezone_name)
-        user_timezone = await UserTimezone.find({"user_id": user_id}).first_or_none()
+        user_timezone = await UserTimezone.get_cached(user_id)
         if not user_timezone:
             user_timezone = UserTimezone(user_id=user_id, timezone=timezone)
             created = True
@@ -433,6 +488,7 @@ class TimezoneCmd(naff.Extension):
             created = False
 
         await user_timezone.save()
+        self.popular_timezones = None
         return user_timezone, created
 
     def get_timezone(self, query: str):
@@ -457,7 +513,25 @@ class TimezoneCmd(naff.Extension):
             results.extend(entries)
         return results
 
+    def reset_stale_results(self):
+        if self.results_generation != self.catalogue.generation:
+            self.results_cache.clear()
+            self.prefix_results.clear()
+            self.popular_timezones = None
+            self.results_generation = self.catalogue.generation
+
     def get_timezone_results(self, query: str):
+        query = " ".join(query.split())
+        self.reset_stale_results()
+
+        cache = self.prefix_results if len(query) <= 2 else self.results_cache
+        results = cache.get(query)
+        if results is None:
+            results = self._search_timezones(query)
+            cache[query] = results
+        return results
+
+    def _search_timezones(self, query: str):
         # Search by offsets and append all timezones with matching offsets to the results
         query = query.strip()
         results = []
@@ -476,10 +550,7 @@ class TimezoneCmd(naff.Extension):
             # Search by full timezone names
             results.extend(fuzzy_autocomplete(query, self.timezones))
 
-            # TODO most popular timezones if empty
-
             # Sort by score and name, the highest score LAST
-            # print("PRE SORT", results)
             results.sort(key=lambda item: item[1])
             # Convert to dict and then back to list to make sure that there are no duplicates in names
             # This way, results with the highest score override results with the lowest score
@@ -491,25 +562,41 @@ class TimezoneCmd(naff.Extension):
 
         return results
 
+    async def get_popular_timezones(self) -> list[str]:
+        self.reset_stale_results()
+        if self.popular_timezones is None:
+            pipeline = [
+                {"$group": {"_id": "$timezone", "count": {"$sum": 1}}},
+                {"$sort": {"count": -1, "_id": 1}},
+                {"$limit": 25},
+            ]
+            results = await UserTimezone.aggregate(pipeline).to_list()
+            self.popular_timezones = [result["_id"] for result in results]
+        return self.popular_timezones
+
+    @coalesce_autocomplete
     async def timezone_autocomplete(self, ctx: AutocompleteContext, query: str):
+        await self.wait_for_catalogue()
+        if not query.strip():
+            # Most popular timezones if empty
+            results = [(name, 100) for name in await self.get_popular_timezones()]
+        else:
+            results = self.get_timezone_results(query)
         # Leave 25 best results
-        results = self.get_timezone_results(query)
         results = results[:25]
         # Format output
-        results = [{"name": self.format_timezone(name), "value": name} for name, score in results]
-        await ctx.send(results)
+        return [{"name": self.format_timezone(name), "value": name} for name, score in results]
 
-    @staticmethod
-    async def parse_time(member: naff.Member, query: str):
+    async def parse_time(self, member: naff.Member, query: str):
         query = query.strip()
         if not query:
             raise InvalidArgument("Input time in any format including natural language (in five minutes, etc)")
 
-        settings = {"PREFER_DATES_FROM": "future"}
-        parser = DateDataParser(settings=settings)
-
-        data = parser.get_date_data(query)
-        d = data.date_obj
+        key = (" ".join(query.lower().split()), int(time.time() // 60))
+        d = self.parsed_times.get(key, naff.MISSING)
+        if d is naff.MISSING:
+            d = await self.date_parser.parse_time(query)
+            self.parsed_times[key] = d
 
         if d is not None:
             if d.tzname() is None:
@@ -526,6 +613,7 @@ class TimezoneCmd(naff.Extension):
         else:
             raise InvalidArgument(f"Cannot interpret `{query}` as a valid time")
 
+    @coalesce_autocomplete
     async def time_autocomplete(self, ctx: AutocompleteContext, query: str):
         try:
             d, t = await self.parse_time(ctx.author, query)
@@ -533,7 +621,7 @@ class TimezoneCmd(naff.Extension):
             suggestion = {"name": str(e), "value": "0"}
         else:
             suggestion = {"name": f"Interpreted as: {d.strftime('%c %Z')}", "value": str(t)}
-        await ctx.send([suggestion])
+        return [suggestion]
 
 
 def setup(bot):
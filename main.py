@@ -14,6 +14,7 @@ from motor import motor_asyncio
 
 from config import load_settings
 from utils.exceptions import BotError, HandledError, send_error
+from utils.startup import readiness, stage
 
 logger = logging.getLogger()
 
@@ -47,19 +48,46 @@ class Bot(naff.Client):
         self.models.append(model)
 
     async def startup(self):
-        for extension in self.get_all_extensions():
-            try:
-                self.load_extension(extension)
-            except Exception as e:
-                logger.error(f"Failed to load extension {extension}: {e}")
-                print(traceback.format_exc())
-
-        if self.config.debug:
-            self.load_extension("naff.ext.debug_extension")
-
+        with stage("extensions"):
+            for extension in self.get_all_extensions():
+                try:
+                    self.load_extension(extension)
+                except Exception as e:
+                    logger.error(f"Failed to load extension {extension}: {e}")
+                    print(traceback.format_exc())
+
+            if self.config.debug:
+                self.load_extension("naff.ext.debug_extension")
+
+        # Commands may arrive before the database is initialized, they wait for it instead of failing
+        for extension in self.ext.values():
+            extension.add_extension_prerun(self.wait_for_database)
+
+        # Gateway connection and database index sync don't depend on each other, so they run concurrently
         self.db = motor_asyncio.AsyncIOMotorClient(self.config.database_address)
-        await beanie.init_beanie(database=self.db.fearless, document_models=self.models)
-        await self.astart(self.config.discord_token)
+        database_task = asyncio.create_task(self.init_database())
+        gateway_task = asyncio.create_task(self.log_gateway_ready())
+        try:
+            await self.astart(self.config.discord_token)
+        finally:
+            database_task.cancel()
+            gateway_task.cancel()
+
+    async def init_database(self):
+        try:
+            with stage("database", gate="database"):
+                await beanie.init_beanie(database=self.db.fearless, document_models=self.models)
+        except Exception as e:
+            logger.critical(f"Could not initialize the database, stopping: {e}")
+            await self.stop()
+
+    async def log_gateway_ready(self):
+        with stage("gateway"):
+            await self.wait_until_ready()
+
+    @staticmethod
+    async def wait_for_database(*args, **kwargs):
+        await readiness.wait("database")
 
     async def on_command_error(self, ctx: InteractionContext, error: Exception, *args, **kwargs):
         if isinstance(error, HandledError):
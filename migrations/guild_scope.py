@@ -0,0 +1,31 @@
+"""
+Assigns a guild to characters, actors, chapters and scenes created before they were scoped by guild.
+Run from the repository root: `python -m migrations.guild_scope <guild_id>`
+Only documents without a `guild_id` are touched, so running it twice is harmless.
+"""
+import sys
+import asyncio
+
+import beanie
+from motor import motor_asyncio
+
+from config import load_settings
+from extensions.character_models import Actor, Character, Chapter, Scene
+
+
+async def main(guild_id: int):
+    config = load_settings()
+    client = motor_asyncio.AsyncIOMotorClient(config.database_address)
+    await beanie.init_beanie(database=client.fearless, document_models=[Actor, Character, Chapter, Scene])
+    for model in (Actor, Character, Chapter, Scene):
+        result = await model.get_motor_collection().update_many(
+            {"guild_id": {"$exists": False}},
+            {"$set": {"guild_id": guild_id}},
+        )
+        print(f"{model.__name__:<10} | {result.modified_count} documents moved to guild {guild_id}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("Usage: python -m migrations.guild_scope <guild_id>")
+    asyncio.run(main(int(sys.argv[1])))
@@ -0,0 +1,79 @@
+import time
+import asyncio
+import logging
+import functools
+from dataclasses import dataclass
+
+from naff import AutocompleteContext
+
+from utils.startup import readiness
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class AutocompleteStats:
+    calls: int = 0
+    answered: int = 0
+    superseded: int = 0
+    deduplicated: int = 0
+    total_time: float = 0
+    max_time: float = 0
+
+    @property
+    def average_time(self) -> float:
+        return self.total_time / self.answered if self.answered else 0
+
+
+autocomplete_stats: dict[str, AutocompleteStats] = {}
+
+# (user, command, option) -> (handler arguments, task computing the choices)
+_in_flight: dict[tuple, tuple[tuple, asyncio.Task]] = {}
+
+
+def coalesce_autocomplete(func):
+    """
+    Wraps an autocomplete handler that returns its choices instead of sending them.
+    Discord sends an interaction per keystroke, so a newer request from the same user for the same option cancels
+    the one still in flight, and identical concurrent requests share a single computation.
+    """
+    stats = autocomplete_stats.setdefault(func.__qualname__, AutocompleteStats())
+
+    @functools.wraps(func)
+    async def wrapper(self, ctx: AutocompleteContext, *args, **kwargs):
+        await readiness.wait("database")
+        start = time.perf_counter()
+        stats.calls += 1
+        key = (ctx.author.id, ctx.invoke_target, ctx.focussed_option)
+        arguments = (func.__qualname__, args, kwargs)
+
+        running = _in_flight.get(key)
+        if running is not None and running[0] == arguments and not running[1].done():
+            stats.deduplicated += 1
+            task = running[1]
+        else:
+            if running is not None:
+                running[1].cancel()
+            task = asyncio.create_task(func(self, ctx, *args, **kwargs))
+            _in_flight[key] = (arguments, task)
+
+        try:
+            # Shielded, so that only a newer request can cancel the shared computation
+            results = await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.cancelled():
+                stats.superseded += 1
+                return
+            raise
+        finally:
+            if (current := _in_flight.get(key)) is not None and current[1] is task and task.done():
+                del _in_flight[key]
+
+        elapsed = time.perf_counter() - start
+        stats.answered += 1
+        stats.total_time += elapsed
+        stats.max_time = max(stats.max_time, elapsed)
+        logger.debug(f"{func.__qualname__} answered in {elapsed * 1000:.1f} ms")
+        await ctx.send(results)
+
+    return wrapper
@@ -1,8 +1,9 @@
 import naff
-from copy import deepcopy
 from naff import SlashCommand, Permissions
 
+from utils.db import NameIndex, resolved_options
 from utils.fuzz import fuzzy_autocomplete
+from utils.exceptions import InvalidArgument
 
 manage_cmd = SlashCommand(name="manage", dm_permission=False, default_member_permissions=Permissions.ADMINISTRATOR)
 info_cmd = SlashCommand(name="info")
@@ -39,8 +40,16 @@ async def generic_move(instance, class_name: str, new_number: int):
     return embed
 
 
-async def generic_autocomplete(query, db_query, last_id=None, use_numbers=False):
+def get_guild_id(ctx: naff.Context) -> int:
+    if ctx.guild is None:
+        raise InvalidArgument("This command can only be used in a server!")
+    return ctx.guild.id
+
+
+async def generic_autocomplete(query, model, guild_id: int, last_id=None, use_numbers=False, where=None, sort_key=None):
     query = query.strip()
+    index = await model.name_index(guild_id)
+    entries = NameIndex.select(index, where, sort_key)
 
     results = []
     if use_numbers:
@@ -49,25 +58,53 @@ async def generic_autocomplete(query, db_query, last_id=None, use_numbers=False)
         except ValueError:
             pass
         else:
-            last_instance = await deepcopy(db_query).find({"number": number}).first_or_none()
-            if last_instance is None:
+            last_entry = next((entry for entry in entries if entry.number == number), None)
+            if last_entry is None:
                 query = ""
             else:
-                results = [last_instance]
+                results = [last_entry]
 
     if not results:
-        instance_list = await deepcopy(db_query).to_list()
         if query:
-            instance_dict = {instance: instance.name for instance in instance_list}
-            results = fuzzy_autocomplete(query, instance_dict)
-            results = [instance for _, _, instance in results]
+            entry_dict = {entry.id: entry.name for entry in entries}
+            results = fuzzy_autocomplete(query, entry_dict)
+            results = [index[entry_id] for _, _, entry_id in results]
         else:
-            results = instance_list
+            results = entries
 
     if not query and last_id is not None:
         # If exists, we move last used instance to the top of the list
-        last_instance = await deepcopy(db_query).find({"_id": last_id}).first_or_none()
-        if last_instance is not None:
-            results = [result for result in results if result.id != last_instance.id]
-            results.insert(0, last_instance)
+        last_entry = next((entry for entry in entries if entry.id == last_id), None)
+        if last_entry is not None:
+            results = [result for result in results if result.id != last_entry.id]
+            results.insert(0, last_entry)
     return results
+
+
+async def resolve_option(ctx: naff.InteractionContext, model, scope, query: str, find):
+    """
+    Resolves a raw option value with `find` (fuzzy search) once per user,
+    later resolutions of the same value load the document by its id instead
+    """
+    key = (ctx.author.id, model, scope, query)
+    if (instance_id := resolved_options.get(key)) is not None:
+        # Renames, deletes and inserts drop the ids they could make stale, see `forget_resolved`
+        if (instance := await model.get(instance_id)) is not None:
+            return instance
+
+    instance = await find()
+    resolved_options[key] = instance.id
+    return instance
+
+
+async def resolve_option_entry(ctx: naff.InteractionContext, model, guild_id: int, scope, query: str, find) -> tuple:
+    """Same as `resolve_option`, but answers with a NameIndex entry, so repeated autocompletes don't touch the db"""
+    key = (ctx.author.id, model, scope, query)
+    index = await model.name_index(guild_id)
+    if (instance_id := resolved_options.get(key)) is not None:
+        if (entry := index.get(instance_id)) is not None:
+            return entry
+
+    instance = await find()
+    resolved_options[key] = instance.id
+    return index.get(instance.id) or instance.index_entry()
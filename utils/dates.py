@@ -0,0 +1,113 @@
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import dateparser
+from dateparser.date import DateDataParser
+from dateparser.search import search_dates
+
+from utils.exceptions import InvalidArgument
+
+logger = logging.getLogger(__name__)
+
+time_settings = {"PREFER_DATES_FROM": "future"}
+
+# Per-process parser, created once by the worker initializer
+_time_parser: DateDataParser | None = None
+
+
+def _init_worker():
+    global _time_parser
+    _time_parser = DateDataParser(settings=time_settings)
+    # First parse loads language data, which is the slow part, so do it before any real work arrives
+    _time_parser.get_date_data("in five minutes")
+    search_dates("see you tomorrow at 5 pm", languages=["en"])
+
+
+def _parse_time(query: str):
+    return _time_parser.get_date_data(query).date_obj
+
+
+def _detect_dates(text: str, settings: dict, languages: list[str]):
+    detected = search_dates(text, settings=settings, languages=languages)
+    if detected is None:
+        # sanity check because somtimes search_dates does not get datetime if it is not surrounded by anything
+        parsed = dateparser.parse(text, settings=settings, languages=languages)
+        return [(text, parsed)] if parsed is not None else []
+
+    results = []
+    for chunk, t in detected:
+        # sanity check because somtimes search_dates gets AM as months etc
+        parsed = dateparser.parse(chunk, settings=settings, languages=languages)
+        results.append((chunk, parsed if parsed is not None else t))
+    return results
+
+
+class DateParserPool:
+    """Runs dateparser in a pool of worker processes, so that parsing never blocks the event loop"""
+
+    def __init__(self, workers: int | None = None, max_pending: int = 32, timeout: float = 10):
+        self.workers = workers or min(4, os.cpu_count() or 1)
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = 0
+        self._executor: ProcessPoolExecutor | None = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+            )
+        return self._executor
+
+    def shutdown(self, terminate: bool = False):
+        if self._executor is not None:
+            # A worker stuck on a pathological input never finishes on its own, so it has to be killed
+            processes = list((self._executor._processes or {}).values()) if terminate else []
+            # Killed workers break the pool, so queued requests get BrokenProcessPool rather than a cancellation
+            self._executor.shutdown(wait=False, cancel_futures=not terminate)
+            self._executor = None
+            for process in processes:
+                process.terminate()
+
+    def _recycle(self, executor: ProcessPoolExecutor, terminate: bool = False):
+        # Requests that were running in the old pool must not shut down the one that replaced it
+        if executor is self._executor:
+            self.shutdown(terminate=terminate)
+
+    async def warm_up(self):
+        # Spawns the workers and runs their initializers before the first real request arrives
+        await asyncio.gather(*(self.parse_time("now") for _ in range(self.workers)), return_exceptions=True)
+
+    async def _run(self, func, *args):
+        if self.pending >= self.max_pending:
+            raise InvalidArgument("I'm busy parsing other dates right now, please try again in a moment!")
+
+        self.pending += 1
+        executor = self.executor
+        try:
+            loop = asyncio.get_running_loop()
+            return await asyncio.wait_for(loop.run_in_executor(executor, func, *args), self.timeout)
+        except asyncio.TimeoutError:
+            # The worker is still busy with the request, restart the pool so it can't wedge it
+            logger.warning(f"Date parsing timed out after {self.timeout}s, restarting the pool")
+            self._recycle(executor, terminate=True)
+            raise InvalidArgument("It took me too long to look for dates and times there, sorry!")
+        except BrokenProcessPool as e:
+            logger.warning(f"Date parser pool broke, restarting it: {e}")
+            self._recycle(executor)
+            raise InvalidArgument("Something went wrong while parsing dates, please try again!")
+        finally:
+            self.pending -= 1
+
+    async def parse_time(self, query: str):
+        return await self._run(_parse_time, query)
+
+    async def detect_dates(self, text: str, settings: dict, languages: list[str]):
+        return await self._run(_detect_dates, text, settings, languages)
@@ -1,14 +1,50 @@
 import re
-from copy import deepcopy
+import asyncio
+from contextlib import contextmanager
+from collections import Counter, defaultdict
+from functools import partial
+from typing import Callable, ClassVar, NamedTuple
 
+import beanie
+from bson import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import DuplicateKeyError
+from pydantic import PrivateAttr
 from beanie.odm.queries.find import FindMany
 from beanie import Document as BeanieDocument
+from naff.client.utils import TTLCache
+
+from utils.exceptions import InvalidArgument
 
 
 class Document(BeanieDocument):
+    """Uniqueness is enforced by unique indexes, violations are reported with `duplicate_message`"""
+
     def __hash__(self):
         return hash(self.id)
 
+    def duplicate_message(self) -> str:
+        return f"{self.__class__.__name__} already exists!"
+
+    @contextmanager
+    def unique_violation(self):
+        try:
+            yield
+        except DuplicateKeyError:
+            raise InvalidArgument(self.duplicate_message())
+
+    async def insert(self, *args, **kwargs):
+        with self.unique_violation():
+            return await super().insert(*args, **kwargs)
+
+    async def replace(self, *args, **kwargs):
+        with self.unique_violation():
+            return await super().replace(*args, **kwargs)
+
+    async def save(self, *args, **kwargs):
+        with self.unique_violation():
+            return await super().save(*args, **kwargs)
+
     class Settings:
         # beanie config
         validate_on_save = True
@@ -19,33 +55,285 @@ class Document(BeanieDocument):
         validate_all = True
 
 
-async def get_new_number(instance, query):
-    number = instance.number if instance.number is not None else float('inf')
-    number = max(number, 1)
-    max_number = await deepcopy(query).find({"_id": {"$ne": instance.id}}).max("number") or 0
-    number = min(number, max_number + 1)
-    return number
+class GuildDocument(Document):
+    """Document that belongs to a single guild (production), all queries on it should be scoped by guild"""
+    guild_id: int
+
+    @classmethod
+    def in_guild(cls, guild_id: int) -> FindMany:
+        return cls.find({"guild_id": guild_id})
+
+
+class NameRecord(NamedTuple):
+    id: ObjectId
+    name: str
+
+
+class NumberRecord(NamedTuple):
+    id: ObjectId
+    number: int | None
+
+
+class NumberedNameRecord(NamedTuple):
+    id: ObjectId
+    name: str
+    number: int | None
+
+
+def raw_find(query: FindMany, fields):
+    """Motor cursor for a beanie query that returns only `fields` as plain dicts, no models are built or validated"""
+    collection = query.document_model.get_motor_collection()
+    cursor = collection.find(query.get_filter_query(), {field: 1 for field in fields})
+    if query.sort_expressions:
+        cursor = cursor.sort(query.sort_expressions)
+    if query.skip_number:
+        cursor = cursor.skip(query.skip_number)
+    if query.limit_number:
+        cursor = cursor.limit(query.limit_number)
+    return cursor
+
+
+async def find_records(query: FindMany, record: type[NamedTuple]) -> list:
+    """Compact records for a query, record fields are read from the document fields with the same name (`id` is `_id`)"""
+    fields = ["_id" if field == "id" else field for field in record._fields]
+    return [record(*(raw.get(field) for field in fields)) async for raw in raw_find(query, fields)]
+
+
+class AggregationQuery:
+    """
+    Aggregation that can be counted and read in pages like a FindMany.
+    `tail` stages run after skip/limit, so per-row lookups are done only for the rows actually returned.
+    """
+
+    def __init__(self, model, pipeline: list[dict], tail: list[dict] | None = None,
+                 record: type[NamedTuple] | None = None):
+        self.model = model
+        self.pipeline = pipeline
+        self.tail = tail or []
+        self.record = record
+        self.skip_number = 0
+        self.limit_number = 0
+
+    def skip(self, n: int) -> "AggregationQuery":
+        self.skip_number = n
+        return self
+
+    def limit(self, n: int) -> "AggregationQuery":
+        self.limit_number = n
+        return self
+
+    async def count(self) -> int:
+        results = await self.model.aggregate(self.pipeline + [{"$count": "count"}]).to_list()
+        return results[0]["count"] if results else 0
+
+    async def to_list(self) -> list:
+        pipeline = list(self.pipeline)
+        if self.skip_number:
+            pipeline.append({"$skip": self.skip_number})
+        if self.limit_number:
+            pipeline.append({"$limit": self.limit_number})
+        results = await self.model.aggregate(pipeline + self.tail).to_list()
+        if self.record is None:
+            return results
+
+        fields = ["_id" if field == "id" else field for field in self.record._fields]
+        return [self.record(*(raw.get(field) for field in fields)) for raw in results]
+
+
+# (user, model, scope, raw option value) -> id it was resolved to, shared by chained autocomplete options and the command
+resolved_options = TTLCache(ttl=10 * 60, soft_limit=500, hard_limit=2500)
+
+
+def forget_resolved(model, instance_id: ObjectId | None = None):
+    # Renamed or removed documents must not be returned for names they no longer have,
+    # and a new document may match a value better than what it was resolved to, so inserts forget them all
+    for key in [key for key in list(resolved_options.keys()) if key[1] is model]:
+        if instance_id is None or resolved_options.get(key) == instance_id:
+            resolved_options.pop(key, None)
+
+
+class NameIndex:
+    """In-process mirror of the names (and a few filter fields) of a model, so autocomplete can answer from memory"""
+    _indexes: dict[type, "NameIndex"] = {}
+
+    def __init__(self, model):
+        self.model = model
+        self.guilds: dict[int, dict[ObjectId, tuple]] = {}  # guild_id -> {instance_id: entry}, loaded lazily per guild
+        self.counts: dict[int, Counter] = {}  # guild_id -> entries per value of the model's `counted_field`
+        self._loading: dict[int, list[Callable[[], None]]] = {}  # guild_id -> changes made while it is being read
+        self._locks: defaultdict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+    @classmethod
+    def of(cls, model) -> "NameIndex":
+        if model not in cls._indexes:
+            cls._indexes[model] = cls(model)
+        return cls._indexes[model]
+
+    async def load(self, guild_id: int) -> dict[ObjectId, tuple]:
+        if guild_id not in self.guilds:
+            async with self._locks[guild_id]:
+                if guild_id not in self.guilds:
+                    # The cursor may have read a document before a write that lands during the read,
+                    # so such writes are replayed on top of what was read before publishing the entries
+                    self._loading[guild_id] = []
+                    try:
+                        cursor = raw_find(self.model.in_guild(guild_id), self.model.index_fields)
+                        entries = [self.model.entry_from_raw(raw) async for raw in cursor]
+                    finally:
+                        changes = self._loading.pop(guild_id)
+                    field = self.model.counted_field
+                    self.counts[guild_id] = Counter(getattr(entry, field) for entry in entries) if field else Counter()
+                    self.guilds[guild_id] = {entry.id: entry for entry in entries}
+                    for change in changes:
+                        change()
+        return self.guilds[guild_id]
+
+    async def counted(self, guild_id: int) -> Counter:
+        await self.load(guild_id)
+        return self.counts[guild_id]
+
+    def _count(self, guild_id: int, entry: tuple | None, step: int):
+        field = self.model.counted_field
+        if field is None or entry is None:
+            return
+        counts = self.counts[guild_id]
+        value = getattr(entry, field)
+        counts[value] += step
+        if counts[value] <= 0:
+            del counts[value]
+
+    def _put(self, guild_id: int, entry: tuple):
+        entries = self.guilds[guild_id]
+        self._count(guild_id, entries.get(entry.id), -1)
+        entries[entry.id] = entry
+        self._count(guild_id, entry, 1)
+
+    def _remove(self, guild_id: int, instance_id: ObjectId):
+        self._count(guild_id, self.guilds[guild_id].pop(instance_id, None), -1)
+
+    def _apply(self, guild_id: int, change: Callable[[], None]):
+        # Guilds that aren't loaded yet will read the change from the db anyway
+        if (changes := self._loading.get(guild_id)) is not None:
+            changes.append(change)
+        elif guild_id in self.guilds:
+            change()
+
+    def update(self, instance):
+        self._apply(instance.guild_id, partial(self._put, instance.guild_id, instance.index_entry()))
+
+    def discard(self, instance):
+        self._apply(instance.guild_id, partial(self._remove, instance.guild_id, instance.id))
+
+    def modify(self, guild_id: int, instance_id: ObjectId, **fields):
+        # For partial updates that don't go through document events
+        def change():
+            if entry := self.guilds[guild_id].get(instance_id):
+                self._put(guild_id, entry._replace(**fields))
+
+        self._apply(guild_id, change)
+
+    def renumber(self, guild_id: int, instance_id: ObjectId, number: int):
+        self.modify(guild_id, instance_id, number=number)
+
+    @staticmethod
+    def select(entries: dict[ObjectId, tuple], where=None, sort_key=None) -> list:
+        entries = [entry for entry in entries.values() if where is None or where(entry)]
+        if sort_key is not None:
+            entries.sort(key=sort_key)
+        return entries
+
+
+class IndexedDocument(GuildDocument):
+    """Document that keeps its NameIndex in sync on every insert, replace and delete"""
+    index_fields: ClassVar[tuple[str, ...]] = ("name",)  # fields read by `entry_from_raw`
+    counted_field: ClassVar[str | None] = None  # entry field whose values the NameIndex keeps counts of
+
+    # Every indexed model defines `index_entry(self)` and the classmethod `entry_from_raw(cls, raw)`,
+    # which builds the same entry from a projected raw document, without validating a whole model
+
+    def __init_subclass__(cls, abstract: bool = False, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # Checked here, otherwise a missing method would only fail once the index is first loaded
+        missing = [name for name in ("index_entry", "entry_from_raw") if not hasattr(cls, name)]
+        if missing and not abstract:
+            raise TypeError(f"{cls.__name__} must define {', '.join(missing)} to be indexed")
+
+    @classmethod
+    async def name_index(cls, guild_id: int) -> dict[ObjectId, tuple]:
+        return await NameIndex.of(cls).load(guild_id)
+
+    @classmethod
+    async def names(cls, guild_id: int, where=None) -> dict[ObjectId, str]:
+        index = await cls.name_index(guild_id)
+        return {entry.id: entry.name for entry in index.values() if where is None or where(entry)}
+
+    @beanie.after_event([beanie.Insert, beanie.Replace])
+    async def update_name_index(self):
+        NameIndex.of(self.__class__).update(self)
+        forget_resolved(self.__class__, self.id)
+
+    @beanie.after_event(beanie.Insert)
+    async def forget_shadowed_resolutions(self):
+        forget_resolved(self.__class__)
+
+    @beanie.after_event(beanie.Delete)
+    async def discard_name_index(self):
+        NameIndex.of(self.__class__).discard(self)
+        forget_resolved(self.__class__, self.id)
+
+
+class NumberedDocument(IndexedDocument, abstract=True):
+    """Document with a contiguous position (`number`) among its siblings, renumbered on every change"""
+    _saved_number: int | None = PrivateAttr(None)
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.id is not None:  # loaded from db
+            self._saved_number = self.number
+
+    # Every numbered model defines `siblings(self) -> FindMany`, the documents it is numbered among
+
+    def __init_subclass__(cls, abstract: bool = False, **kwargs):
+        super().__init_subclass__(abstract=abstract, **kwargs)
+        if not abstract and not hasattr(cls, "siblings"):
+            raise TypeError(f"{cls.__name__} must define siblings to be numbered")
+
+    @beanie.after_event([beanie.Insert, beanie.Replace])
+    async def reshuffle(self):
+        # Plain renames etc. don't move the instance, so there is nothing to renumber
+        if self.number is None or self.number != self._saved_number:
+            self.number = await reshuffle_numbers(self.siblings(), self.guild_id, current_instance=self)
+        self._saved_number = self.number
+
+    @beanie.after_event(beanie.Delete)
+    async def reshuffle_siblings(self):
+        await reshuffle_numbers(self.siblings(), self.guild_id)
 
 
-async def reshuffle_numbers(query, current_instance=None, to_delete=False):
-    instances: list = await query.sort("+number").to_list()
-    return_number = None
-    if current_instance is not None:
+async def reshuffle_numbers(query: FindMany, guild_id: int, current_instance=None):
+    siblings = await find_records(query.sort("+number"), NumberRecord)
+    numbers = {sibling.id: sibling.number for sibling in siblings}
+    ids = [sibling.id for sibling in siblings]
+    if current_instance is not None and current_instance.id in numbers:
         # We remove current instance from the list and add it back on the *proper* position
-        new_instances = [instance for instance in instances if instance.id != current_instance.id]
-        if instances != new_instances:  # Don't add instance back if it wasn't in the list
-            instances = new_instances
-            current_number = current_instance.number-1 if current_instance.number is not None else len(instances)
-            instances.insert(current_number, current_instance)
+        ids.remove(current_instance.id)
+        current_number = current_instance.number-1 if current_instance.number is not None else len(ids)
+        ids.insert(current_number, current_instance.id)
 
-    for number, instance in enumerate(instances, 1):
-        instance.number = number
-        await instance.save(skip_actions=["validate_db", "reshuffle"])
+    # Only write documents whose number actually changes, all in one round trip
+    changes = {instance_id: number for number, instance_id in enumerate(ids, 1) if numbers[instance_id] != number}
+    if changes:
+        model = query.document_model
+        requests = [UpdateOne({"_id": instance_id}, {"$set": {"number": number}}) for instance_id, number in changes.items()]
+        await model.get_motor_collection().bulk_write(requests, ordered=False)
 
-        if current_instance is not None and instance.id == current_instance.id:
-            return_number = number
+        index = NameIndex.of(model)
+        for instance_id, number in changes.items():
+            index.renumber(guild_id, instance_id, number)
 
-    return return_number
+    if current_instance is not None and current_instance.id in numbers:
+        return ids.index(current_instance.id) + 1
+    return None
 
 
 def validate_name(value: str):
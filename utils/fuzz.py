@@ -1,8 +1,13 @@
+import re
+
+from bson import ObjectId
 from rapidfuzz import fuzz, process
 # from rapidfuzz.distance.Levenshtein import normalized_similarity
 from rapidfuzz.distance.JaroWinkler import similarity
 from beanie.odm.queries.find import FindMany
 from copy import deepcopy
+
+from utils.db import NameRecord, find_records, validate_name
 # def scorer(s1, s2, **kwargs):
 #     return normalized_distance()
 
@@ -12,16 +17,31 @@ def fuzzy_autocomplete(query: str, choices):
     return results
 
 
-async def fuzzy_find_obj(query: str, db_query: FindMany):
+async def fuzzy_find_obj(query: str, db_query: FindMany, names: dict[ObjectId, str] | None = None):
+    """
+    Exact and prefix name matches are answered by the db (names are stored normalized, so both can use the index),
+    anything else is fuzzy matched against `names` (or just the names from `db_query`), and only the winner is fetched
+    """
     query = query.replace("_", " ")
-    obj = await deepcopy(db_query).find({'name': query}).first_or_none()
-    if obj is None:  # user gave us incorrect or incomplete name
-        obj_choices = await deepcopy(db_query).find().to_list()
-        obj_choices = {o: o.name for o in obj_choices}
-        result = process.extractOne(query, obj_choices, scorer=fuzz.WRatio, score_cutoff=50)
+    name = validate_name(query)
+    obj = await deepcopy(db_query).find({'name': name}).first_or_none()
+    if obj is not None:
+        return obj
+
+    # user gave us incorrect or incomplete name
+    prefixed = deepcopy(db_query).find({'name': {'$regex': f"^{re.escape(name)}"}})
+    candidates = dict(await find_records(prefixed, NameRecord))
+    result = process.extractOne(query, candidates, scorer=fuzz.WRatio, score_cutoff=50) if candidates else None
+
+    if result is None:
+        if names is None:
+            names = dict(await find_records(deepcopy(db_query), NameRecord))
+        result = process.extractOne(query, names, scorer=fuzz.WRatio, score_cutoff=50)
 
-        if result is None:
-            raise ValueError(f"Can't find {query}!")
+    if result is None:
+        raise ValueError(f"Can't find {query}!")
 
-        obj = result[2]
+    obj = await db_query.document_model.get(result[2])
+    if obj is None:  # removed after names were read
+        raise ValueError(f"Can't find {query}!")
     return obj
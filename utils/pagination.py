@@ -0,0 +1,105 @@
+from copy import deepcopy
+from typing import Awaitable, Callable, NamedTuple
+
+import naff
+from naff.client.utils import TTLCache
+from beanie.odm.queries.find import FindMany
+
+from utils.db import AggregationQuery, NumberedNameRecord, find_records
+from utils.text import format_entry, join_lines
+
+FIELD_ENTRIES = 20
+
+
+class Paginator:
+    """
+    Pages through a db query, only the page currently shown is fetched and rendered.
+    Paginators are remembered per message, so its navigation buttons keep working until the paginator expires.
+    With a `record`, a FindMany page is read as those records instead of full documents.
+    """
+    prev_id = "paginator:prev"
+    next_id = "paginator:next"
+    active = TTLCache(ttl=15 * 60, soft_limit=100, hard_limit=250)
+
+    def __init__(self, query: FindMany | AggregationQuery, render: Callable[[list, "Paginator"], Awaitable[naff.Embed]],
+                 page_size: int = FIELD_ENTRIES, record: type[NamedTuple] | None = None):
+        self.query = query
+        self.render = render
+        self.page_size = page_size
+        self.record = record
+        self.page = 0
+        self.has_next = False
+        self.author_id: int | None = None  # only the one who requested the list can page through it
+
+    async def fetch(self) -> list:
+        # One extra document tells whether there is a next page, without counting the whole result
+        query = deepcopy(self.query).skip(self.page * self.page_size).limit(self.page_size + 1)
+        if self.record is not None:
+            documents = await find_records(query, self.record)
+        else:
+            documents = await query.to_list()
+        self.has_next = len(documents) > self.page_size
+        return documents[:self.page_size]
+
+    async def embed(self) -> naff.Embed:
+        embed = await self.render(await self.fetch(), self)
+        if self.paged:
+            embed.set_footer(f"Page {self.page + 1}")
+        return embed
+
+    @property
+    def paged(self) -> bool:
+        return self.page > 0 or self.has_next
+
+    def components(self) -> list:
+        if not self.paged:
+            return []
+        prev_button = naff.Button(style=naff.ButtonStyles.GRAY, emoji="◀️", custom_id=self.prev_id,
+                                  disabled=self.page == 0)
+        next_button = naff.Button(style=naff.ButtonStyles.GRAY, emoji="▶️", custom_id=self.next_id,
+                                  disabled=not self.has_next)
+        return [naff.ActionRow(prev_button, next_button)]
+
+    async def send(self, ctx: naff.InteractionContext, **kwargs) -> naff.Message:
+        embed = await self.embed()
+        components = self.components()
+        message = await ctx.send(embed=embed, components=components, **kwargs)
+        if components:
+            self.author_id = ctx.author.id
+            self.active[message.id] = self
+        return message
+
+    @classmethod
+    async def navigate(cls, ctx: naff.ComponentContext):
+        if ctx.custom_id not in (cls.prev_id, cls.next_id):
+            return
+
+        paginator = cls.active.get(ctx.message.id)
+        if paginator is None:  # expired, the list has to be requested again
+            await ctx.edit_origin(components=[])
+            return
+        if ctx.author.id != paginator.author_id:
+            await ctx.send("Only the one who requested this list can change its pages!", ephemeral=True)
+            return
+
+        step = 1 if ctx.custom_id == cls.next_id else -1
+        paginator.page = max(0, paginator.page + step)
+        embed = await paginator.embed()
+        await ctx.edit_origin(embed=embed, components=paginator.components())
+
+
+async def numbered_entries(query: FindMany, highlight=None, size: int = FIELD_ENTRIES) -> tuple[str, int]:
+    """Up to `size` numbered entries around the highlighted one (for embed fields that can't be paged) and total count"""
+    total = await deepcopy(query).count()
+    first = 1
+    if highlight is not None and highlight.number is not None:
+        first = max(1, min(highlight.number - size // 2, total - size + 1))
+
+    query = deepcopy(query).find({"number": {"$gte": first}}).sort("+number").limit(size)
+    documents = await find_records(query, NumberedNameRecord)
+    lines = [format_entry(document, highlight) for document in documents]
+    if documents and documents[0].number > 1:
+        lines.insert(0, "…")
+    if documents and documents[-1].number < total:
+        lines.append("…")
+    return join_lines(lines), total
@@ -0,0 +1,99 @@
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Awaitable, Callable
+
+import naff
+from bson import ObjectId
+
+logger = logging.getLogger(__name__)
+
+# (guild_id, actor_ids or None for everyone) -> {user_id: names of managed roles the member should have}
+DesiredRoles = Callable[[int, list[ObjectId] | None], Awaitable[dict[int, set[str]]]]
+
+
+class RoleReconciler:
+    """
+    Keeps bot-managed roles of members in line with what they should have.
+    Changed actors are queued and reconciled in debounced batches, every member gets at most one edit
+    that sets their full role list.
+    """
+
+    def __init__(self, bot: naff.Client, managed_roles: list[str], desired_roles: DesiredRoles,
+                 delay: float = 2, concurrency: int = 4):
+        self.bot = bot
+        self.managed_roles = set(managed_roles)
+        self.desired_roles = desired_roles
+        self.delay = delay
+        self.concurrency = concurrency
+
+        self.dirty: defaultdict[int, set[ObjectId]] = defaultdict(set)  # guild_id -> actor ids
+        self.tasks: dict[int, asyncio.Task] = {}  # guild_id -> pending flush
+
+    def queue(self, guild_id: int, *actor_ids: ObjectId | None):
+        self.dirty[guild_id].update(actor_id for actor_id in actor_ids if actor_id is not None)
+        if self.dirty[guild_id] and guild_id not in self.tasks:
+            self.tasks[guild_id] = asyncio.create_task(self._flush(guild_id))
+
+    def cancel(self):
+        for task in self.tasks.values():
+            task.cancel()
+        self.tasks.clear()
+
+    async def _flush(self, guild_id: int):
+        # Everything queued for the guild while we wait goes into the same batch
+        await asyncio.sleep(self.delay)
+        del self.tasks[guild_id]
+        actor_ids = self.dirty.pop(guild_id, set())
+        try:
+            await self.reconcile(guild_id, list(actor_ids))
+        except Exception as e:
+            logger.warning(f"Could not reconcile roles of {len(actor_ids)} actors in guild {guild_id}: {e}")
+
+    async def resync_all(self, guild_id: int) -> int:
+        """Reconciles every actor of the guild, returns amount of edited members"""
+        return await self.reconcile(guild_id, None)
+
+    async def reconcile(self, guild_id: int, actor_ids: list[ObjectId] | None) -> int:
+        guild = await self.bot.fetch_guild(guild_id)
+        desired = await self.desired_roles(guild_id, actor_ids)
+        roles = await self._get_roles(guild, set().union(*desired.values()))
+        managed_ids = {role.id for role in guild.roles if role.name in self.managed_roles}
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def apply(user_id: int, role_names: set[str]) -> bool:
+            async with semaphore:
+                member = await guild.fetch_member(user_id)
+                if member is None:
+                    return False
+
+                current = {role.id for role in member.roles}
+                target = (current - managed_ids) | {roles[name].id for name in role_names if name in roles}
+                if target == current:
+                    return False
+                # Setting the full list is a single request, but a role someone else changes between the fetch
+                # above and this edit is reverted, the fetch is done right before the edit to keep that window small
+                try:
+                    await member.edit(roles=list(target), reason="Automatically updated to match assigned characters")
+                except naff.errors.Forbidden as e:
+                    logger.warning(f"Could not update roles of {member} in {guild}: {e}")
+                    return False
+                return True
+
+        results = await asyncio.gather(*(apply(user_id, names) for user_id, names in desired.items()),
+                                       return_exceptions=True)
+        for user_id, result in zip(desired, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Could not reconcile roles of user {user_id} in {guild}: {result}")
+        return sum(result is True for result in results)
+
+    @staticmethod
+    async def _get_roles(guild: naff.Guild, role_names: set[str]) -> dict[str, naff.Role]:
+        roles = {role.name: role for role in guild.roles if role.name in role_names}
+        for role_name in role_names - roles.keys():
+            try:
+                roles[role_name] = await guild.create_role(name=role_name)
+            except naff.errors.Forbidden as e:
+                logger.warning(f"Could not create role `{role_name}` in {guild}: {e}")
+        return roles
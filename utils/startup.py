@@ -0,0 +1,60 @@
+import time
+import asyncio
+import logging
+from contextlib import contextmanager
+from collections import defaultdict
+
+from utils.exceptions import BotError
+
+logger = logging.getLogger(__name__)
+
+started = time.perf_counter()
+
+
+class NotReady(BotError):
+    pass
+
+
+class Readiness:
+    """Named gates for things initialized in the background during startup, so dependent code can wait for them"""
+
+    def __init__(self):
+        self.gates: defaultdict[str, asyncio.Event] = defaultdict(asyncio.Event)
+        self.failures: dict[str, BaseException] = {}
+
+    def set(self, name: str):
+        self.gates[name].set()
+
+    def fail(self, name: str, error: BaseException):
+        # Waiters are released too, they get an error instead of waiting forever
+        self.failures[name] = error
+        self.gates[name].set()
+
+    def is_set(self, name: str) -> bool:
+        return self.gates[name].is_set() and name not in self.failures
+
+    async def wait(self, name: str):
+        await self.gates[name].wait()
+        if name in self.failures:
+            raise NotReady(f"Sorry, I could not finish starting up ({name}), please try again later!")
+
+
+readiness = Readiness()
+
+
+@contextmanager
+def stage(name: str, gate: str | None = None):
+    """Logs how long a startup stage took (and when it finished since the start), then opens its gate"""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        logger.error(f"Startup stage '{name}' failed after {time.perf_counter() - start:.2f}s: {e!r}")
+        if gate is not None:
+            readiness.fail(gate, e)
+        raise
+
+    end = time.perf_counter()
+    logger.info(f"Startup stage '{name}' took {end - start:.2f}s, done at {end - started:.2f}s")
+    if gate is not None:
+        readiness.set(gate)
@@ -26,6 +26,24 @@ def make_table(rows: list[list[str]], wrap: list[bool]) -> list[str]:
     return lines
 
 
+def join_lines(lines: list[str], limit: int = 1024) -> str:
+    """Joins lines, dropping the ones that don't fit into `limit` characters (Discord field length by default)"""
+    text = "\n".join(lines)
+    if len(text) <= limit:
+        return text
+
+    kept = []
+    length = 0
+    for i, line in enumerate(lines):
+        more = f"… and {len(lines) - i} more"
+        if length + len(line) + 1 + len(more) > limit:
+            kept.append(more)
+            break
+        kept.append(line)
+        length += len(line) + 1
+    return "\n".join(kept)
+
+
 def format_entry(instance, highlight=None):
     if highlight is not None:
         to_highlight = instance.id == highlight.id
@@ -0,0 +1,161 @@
+import json
+import time
+import bisect
+import logging
+import threading
+from pathlib import Path
+from datetime import datetime
+from collections import defaultdict
+from typing import NamedTuple
+
+import pytz
+
+logger = logging.getLogger(__name__)
+
+
+class TimezoneInfo(NamedTuple):
+    abbreviation: str
+    offset: str  # as in strftime("%z"), e.g. "+0300"
+    next_transition: float | None  # utc timestamp of the next DST/offset change, if any
+
+
+def offset_variations(offset: str) -> list[str]:
+    sign, hours, minutes = offset[0], int(offset[1:3]), int(offset[3:])
+    sign_variants = ["", "+"] if sign == "+" else ["-"]
+    minutes_variants = ["", f"{minutes}"]
+    v2 = f"{hours}"
+    results = []
+    for v1 in sign_variants:
+        for v3 in minutes_variants:
+            results.append(v1 + v2 + v3)
+    return results
+
+
+class TimezoneCatalogue:
+    """
+    Abbreviation and offset lookup tables for all pytz timezones.
+    Built once and cached on disk; entries are recomputed only when their zone passes a DST/offset transition.
+    """
+    version = 1
+
+    def __init__(self, cache_path: Path):
+        self.cache_path = cache_path
+        self.timezones = pytz.all_timezones
+
+        self.zones: dict[str, TimezoneInfo] = {}
+        self.abbreviations: defaultdict[str, list] = defaultdict(list)
+        self.offsets: defaultdict[str, list] = defaultdict(list)
+        self.loaded = False  # set only once tables are built, so readers never see a half-loaded catalogue
+        self._lock = threading.Lock()  # loaded from a warm-up thread and, on demand, from the event loop
+        self.generation = 0  # bumped every time lookup tables change, so dependent caches know to reset
+
+    @staticmethod
+    def zone_info(name: str, now: float) -> TimezoneInfo:
+        timezone = pytz.timezone(name)
+        local_now = datetime.fromtimestamp(now, timezone)
+
+        next_transition = None
+        transitions = getattr(timezone, "_utc_transition_times", None)  # only DstTzInfo zones have transitions
+        if transitions:
+            position = bisect.bisect_right(transitions, datetime.utcfromtimestamp(now))
+            if position < len(transitions):
+                next_transition = transitions[position].replace(tzinfo=pytz.UTC).timestamp()
+
+        return TimezoneInfo(local_now.strftime("%Z"), local_now.strftime("%z"), next_transition)
+
+    def load(self):
+        if self.loaded:
+            return
+
+        with self._lock:
+            if self.loaded:  # another thread finished loading while we waited
+                return
+
+            now = time.time()
+            if not self._read_cache():
+                start = time.perf_counter()
+                self.zones = {name: self.zone_info(name, now) for name in self.timezones}
+                logger.info(f"Built timezone catalogue in {time.perf_counter() - start:.2f}s")
+                self._write_cache()
+            elif self._refresh_zones(now):
+                self._write_cache()
+            self._build_tables()
+            self.loaded = True
+
+    def refresh(self, now: float | None = None) -> int:
+        """Recomputes zones that passed their transition, returns amount of updated zones"""
+        if not self.loaded:
+            self.load()
+            return 0
+
+        with self._lock:
+            stale = self._refresh_zones(now or time.time())
+            if stale:
+                self._build_tables()
+                self._write_cache()
+            return stale
+
+    def _refresh_zones(self, now: float) -> int:
+        stale = [name for name, info in self.zones.items()
+                 if info.next_transition is not None and info.next_transition <= now]
+        for name in stale:
+            self.zones[name] = self.zone_info(name, now)
+
+        if stale:
+            logger.info(f"Refreshed {len(stale)} timezones after DST transitions")
+        return len(stale)
+
+    @property
+    def next_transition(self) -> float | None:
+        self.load()
+        transitions = [info.next_transition for info in self.zones.values() if info.next_transition is not None]
+        return min(transitions, default=None)
+
+    def _build_tables(self):
+        abbreviations = defaultdict(list)
+        offsets = defaultdict(list)
+        for name in self.timezones:
+            info = self.zones[name]
+            abbreviations[info.abbreviation].append(name)
+            for offset in offset_variations(info.offset):
+                offsets[offset].append(name)
+
+        self.abbreviations = abbreviations
+        self.offsets = offsets
+        self.generation += 1
+
+    def _read_cache(self) -> bool:
+        try:
+            with open(self.cache_path, encoding="utf-8") as f:
+                text = f.read()
+        except OSError:
+            return False
+
+        try:
+            data = json.loads(text)
+            if data.get("version") != self.version or data.get("pytz") != pytz.__version__:
+                return False
+            zones = {name: TimezoneInfo(*info) for name, info in data["zones"].items()}
+        except (ValueError, AttributeError, KeyError, TypeError) as e:
+            # Unreadable or malformed cache (e.g. hand-edited or truncated), it is simply rebuilt
+            logger.warning(f"Ignoring timezone catalogue cache {self.cache_path}: {e!r}")
+            return False
+
+        if set(zones) != set(self.timezones):
+            return False
+
+        self.zones = zones
+        return True
+
+    def _write_cache(self):
+        data = {
+            "version": self.version,
+            "pytz": pytz.__version__,
+            "zones": self.zones,
+        }
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.cache_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, separators=(",", ":"))
+        except OSError as e:
+            logger.warning(f"Could not write timezone catalogue cache to {self.cache_path}: {e}")